@@ -22,19 +22,25 @@ Differences:
 
 
 """
+import array
 import logging
 import re
 
 import cherrypy
 import routes
 
-from sqlalchemy import or_, and_, select
+from sqlalchemy import (
+    Integer, any_, and_, bindparam, func, intersect, literal_column, select, union)
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.orm import selectinload, undefer
 from genshi.filters import HTMLFormFiller
 
 from libgutenberg.Models import (
     Alias, Attribute, Author, Book, BookAuthor, Category, File, Lang, Locc, Subject)
 
 import BaseSearcher
+import Bitmaps
+import Caches
 from errors import ErrorPage
 from Page import Page
 from Formatters import formatters
@@ -46,6 +52,9 @@ config = cherrypy.config
 BROWSE_KEYS = {'lang': 'l', 'locc': 'lcc'}
 PAGESIZE = 100
 MAX_RESULTS = 5000
+MAX_CANDIDATES = 20000   # restrict term queries to at most this many matched books
+DB_TERM_ORDER = ('author', 'subject', 'title', 'summary')
+SIMPLE = literal_column("'simple'::regconfig")   # see: sql/advsearch_trgm.sql
 
 
 
@@ -53,7 +62,7 @@ class AdvSearcher(BaseSearcher.OpenSearch):
     """ this object passes the context for the page renderer """
     def __init__(self):
         # don't want searchterms from quick search
-        cherrypy.session.pop('search_terms', None)
+        BaseSearcher.session().pop('search_terms', None)
         super().__init__()
         self.items_per_page = PAGESIZE
 
@@ -70,6 +79,234 @@ class AdvSearcher(BaseSearcher.OpenSearch):
 RE_SPLIT = re.compile(r'[\W%_\\]+')
 MAX_WORDS = 5
 
+def with_entry_relations(query):
+    """ Eager-load what advresults.html shows of a book: the title,
+    authors, languages and categories (for is_audiobook).
+
+    The relations are loaded in one query each for the whole page,
+    instead of one query per book.
+    """
+    return query.options(
+        undefer(Book.title),
+        selectinload(Book.authors).joinedload(BookAuthor.author),
+        selectinload(Book.langs),
+        selectinload(Book.categories),
+    )
+
+
+def entries(session, pks):
+    """ Return the books with pks, in the order of pks. """
+    if not pks:
+        return []
+    query = with_entry_relations(session.query(Book).filter(Book.pk.in_(pks)))
+    books = {book.pk: book for book in query}
+    return [books[pk] for pk in pks if pk in books]
+
+
+def by_author(query):
+    """ Order a query of book pks by first author and return the pks,
+    at most MAX_RESULTS + 1 of them. """
+    query = query.join(
+        Book.authors.and_(BookAuthor.heading == 1)).join(BookAuthor.author).order_by(
+        Author.name, Book.pk).limit(MAX_RESULTS + 1)
+    # a book with two first authors is listed under the first one
+    return list(dict.fromkeys(row[0] for row in query))
+
+
+def term_query(query, key, val):
+    """ Return (label, display value, facet value, query of matching book pks)
+    for a search term, or None if the term is not valid.
+
+    The text predicates are written so they can use the indexes in
+    sql/advsearch_trgm.sql.
+    """
+    if key == 'filetype':
+        return 'Filetype', val, val, query.join(File).filter(File.fk_filetypes == val)
+
+    if key == 'lang':
+        return ('Language', BaseSearcher.language_map.get(val, val), val,
+                query.join(Book.langs).filter(Lang.id == val))
+
+    if key == 'locc':
+        return 'LoC Class', val.upper(), val, query.join(Book.loccs).filter(Locc.id == val)
+
+    if key == 'category':
+        try:
+            val = int(val)
+        except ValueError:
+            return None
+        return ('Category', catname(val), val,
+                query.join(Book.categories).filter(Category.pk == val))
+
+    if key == 'author':
+        word = "%{}%".format(val)
+        # a union, not an OR across a join, so each side uses its own index
+        subq = union(
+            select(Author.id).filter(Author.name.ilike(word)),
+            select(Alias.fk_authors).filter(Alias.alias.ilike(word)),
+        )
+        return 'Author', val, val, query.join(Book.authors).filter(
+            BookAuthor.fk_authors.in_(subq))
+
+    if key == 'title':
+        if len(val) <= 2:
+            return None
+        word = "%{}%".format(val)
+        return 'Title', val, val, query.join(Book.attributes).filter(and_(
+            Attribute.fk_attriblist.in_([240, 245, 246]),
+            Attribute.text.ilike(word),
+        ))
+
+    if key == 'summary':
+        # whole words: full-text search without stemming
+        return 'Summary', val, val, query.join(Book.attributes).filter(and_(
+            Attribute.fk_attriblist == 520,
+            func.to_tsvector(SIMPLE, Attribute.text).op('@@')(
+                func.phraseto_tsquery(SIMPLE, val)),
+        ))
+
+    if key == 'subject':
+        word = "%{}%".format(val)
+        return 'Subject', val, val, query.join(Book.subjects).filter(
+            Subject.subject.ilike(word),
+        )
+
+    return None
+
+
+def evaluation_order(term):
+    """ Sort key for the terms: the filter facets first, by their exact
+    counts from the bitmaps, then the database terms in a fixed order.
+
+    There is no cheap estimate for the substring matches of the text
+    terms, so they keep the order of DB_TERM_ORDER.
+    """
+    facet, val = term[0], term[3]
+    bits = Bitmaps.get(facet, val) if facet in Bitmaps.FACETS else None
+    if bits is not None:
+        return 0, Bitmaps.count(bits)
+    if facet in DB_TERM_ORDER:
+        return 1, DB_TERM_ORDER.index(facet)
+    return 1, len(DB_TERM_ORDER)
+
+
+def term_pks(query, candidates):
+    """ Return the pks matching a term query and its count of matches.
+
+    If candidates is given, only the pks among the candidates are
+    fetched. The count is always the term's own, over all books.
+    """
+    if candidates is None:
+        pks = set(row[0] for row in query.all())
+        return pks, len(pks)
+
+    count = select(func.count()).select_from(query.distinct().subquery()).scalar_subquery()
+    rows = query.filter(Book.pk == any_(bindparam(
+        'candidates', candidates, type_=ARRAY(Integer)))).add_columns(count).all()
+    if not rows:
+        # no books among the candidates, we still want the count
+        return set(), query.session.query(count).scalar()
+    return set(row[0] for row in rows), rows[0][1]
+
+
+def bitmap_search(terms):
+    """ Intersect the terms as bitmaps.
+
+    The filter facets come from memory, the other terms from the
+    database. The facets go first, and the database queries fetch
+    only the books matched so far while there are at most
+    MAX_CANDIDATES of them. The counts shown are the terms' own.
+    Returns (selections, total, pks).
+    """
+    terms = sorted(terms, key=evaluation_order)
+    selections = []
+    resultbits = None
+    for facet, label, display, val, query in terms:
+        bits = Bitmaps.get(facet, val) if facet in Bitmaps.FACETS else None
+        if bits is None:
+            candidates = None
+            if resultbits is not None and Bitmaps.count(resultbits) <= MAX_CANDIDATES:
+                candidates = Bitmaps.to_pks(resultbits)
+            pks, count = term_pks(query, candidates)
+            bits = Bitmaps.from_pks(pks)
+        else:
+            count = Bitmaps.count(bits)
+        resultbits = resultbits & bits if resultbits is not None else bits
+        selections.append((label, display, count))
+
+    if resultbits is None:
+        return selections, 0, []
+    return selections, Bitmaps.count(resultbits), Bitmaps.to_pks(resultbits)
+
+
+def sql_search(session, terms):
+    """ Intersect the terms in the database, in one statement.
+
+    Every term becomes a CTE, the result is their INTERSECT. The
+    statement returns the matching pks, sorted by first author,
+    together with the total and the per-term counts.
+    Returns (selections, total, pks).
+    """
+    if not terms:
+        return [], 0, []
+
+    ctes = [query.distinct().cte() for facet, label, display, val, query in terms]
+    if len(ctes) > 1:
+        hits = intersect(*[select(cte.c.pk) for cte in ctes]).cte('hits')
+    else:
+        hits = ctes[0]
+    counts = [select(func.count()).select_from(cte).scalar_subquery()
+              for cte in [hits] + ctes]
+
+    rows = session.query(Book.pk, *counts).join(
+        Book.authors.and_(BookAuthor.heading == 1)).join(BookAuthor.author).filter(
+        Book.pk.in_(select(hits.c.pk))).order_by(
+        Author.name, Book.pk).limit(MAX_RESULTS + 1).all()
+    if rows:
+        counts = rows[0][1:]
+    else:
+        # no books, we still want the counts
+        counts = session.query(*counts).one()
+
+    selections = [(label, display, num_rows) for (facet, label, display, val, query), num_rows
+                  in zip(terms, counts[1:])]
+    return selections, counts[0], list(dict.fromkeys(row[0] for row in rows))
+
+
+def search(session, searchterms):
+    """ Run an advanced search, or get it from the cache.
+
+    Returns (selections, total, pks sorted by first author). The pks
+    are only listed if there are at most MAX_RESULTS of them.
+    """
+    cache = Caches.get('advsearch', 200, 900)
+    key = tuple(sorted(searchterms))
+    result = cache.get(key)
+    if result is not None:
+        return result
+
+    query = session.query(Book.pk)
+    terms = []
+    for facet, val in searchterms:
+        term = term_query(query, facet, val)
+        if term is not None:
+            terms.append((facet,) + term)
+
+    if Bitmaps.loaded():
+        selections, total, pks = bitmap_search(terms)
+        if 0 < total <= MAX_RESULTS:
+            pks = by_author(query.filter(Book.pk == any_(bindparam(
+                'pks', pks, type_=ARRAY(Integer)))))
+    else:
+        selections, total, pks = sql_search(session, terms)
+    if total > MAX_RESULTS:
+        pks = []
+
+    result = (selections, total, array.array('i', pks))
+    cache.put(key, result)
+    return result
+
+
 class AdvSearchPage(Page):
     """ search term => list of items """
     def __init__(self):
@@ -79,18 +316,6 @@ class AdvSearchPage(Page):
         self.formatter = formatters['html']
 
     def index (self, **kwargs):
-        def entries(results, offset):
-            """ results is a list of book ids, sorted by first Author,
-            the query lazily returns book objects
-            """
-            query = session.query(Book).join(
-                Book.authors.and_(BookAuthor.heading == 1)).join(BookAuthor.author).filter(
-                Book.pk.in_(results)).order_by(Author.name).offset(offset).limit(PAGESIZE)
-
-            for book in query:
-                yield book
-
-
         os = AdvSearcher()
         params = cherrypy.request.params.copy()
         cherrypy.log(str(params), context = 'PARAMS', severity = logging.ERROR)
@@ -130,9 +355,6 @@ class AdvSearchPage(Page):
             
         # multiple terms, create a query
         session = cherrypy.engine.pool.Session()
-        query = session.query(Book.pk)
-        selections = []
-        resultpks = None
         searchterms = []
         for key in terms:
             if key in ['author', 'title', 'subject']:
@@ -147,84 +369,11 @@ class AdvSearchPage(Page):
                 if len(searchterm) > 0:
                     searchterms.append((key, searchterm))
 
-        pks = []
-        for key, val in searchterms:
-            if key == 'filetype':
-                pks = query.join(File).filter(File.fk_filetypes == val).all()
-                key = 'Filetype'
-
-            elif key == 'lang':
-                pks = query.join(Book.langs).filter(Lang.id == val).all()
-                val = BaseSearcher.language_map.get(val, val)
-                key = 'Language'
-
-            elif key == 'locc':
-                pks = query.join(Book.loccs).filter(Locc.id == val).all()
-                val = val.upper()
-                key = 'LoC Class'
-
-            elif key == 'category':
-                try:
-                    val = int(val)
-                except ValueError:
-                    continue
-                pks = query.join(Book.categories).filter(Category.pk == val).all()
-                val = catname(val)
-                key = 'Category'
-
-            elif key == 'author':
-                word = "%{}%".format(val)
-                subq = select(Author.id).join(Author.aliases).filter(
-                    Alias.alias.ilike(word))
-                pks = query.join(Book.authors).join(BookAuthor.author).filter(or_(
-                    Author.name.ilike(word),
-                    Author.id.in_(subq),
-                )).all()
-                key = 'Author'
-
-            elif key == 'title':
-                if len(val) > 2:
-                    word = "%{}%".format(val)
-                    pks = query.join(Book.attributes).filter(and_(
-                        Attribute.fk_attriblist.in_([240, 245, 246]),
-                        Attribute.text.ilike(word),
-                    )).all()
-                    key = 'Title'
-                else:
-                    continue
-
-            elif key == 'summary':
-                word = "% {} %".format(val)
-                pks = query.join(Book.attributes).filter(and_(
-                    Attribute.fk_attriblist == 520,
-                    Attribute.text.ilike(word),
-                )).all()
-                key = 'Summary'
-
-            elif key == 'subject':
-                word = "%{}%".format(val)
-                pks = query.join(Book.subjects).filter(                    
-                    Subject.subject.ilike(word),
-                ).all()
-                key = 'Subject'
-            else:
-                pks = []
-                continue
-            pks = {row[0] for row in pks}
-            resultpks = resultpks.intersection(pks) if resultpks is not None else pks
-            num_rows = len(pks)
-            selections.append((key, val, num_rows))
-            if len(resultpks) == 0:
-                break
-
-        os.total_results = len(resultpks) if resultpks is not None else 0
-        os.finalize()
+        selections, os.total_results, pks = search(session, searchterms)
         offset = PAGESIZE * (pageno - 1)
+        os.entries = entries(session, list(pks[offset:offset + PAGESIZE]))
+        os.finalize()
         os.start_index = offset + 1
-        if os.total_results > MAX_RESULTS:
-            os.entries = []
-        else:
-            os.entries = entries(resultpks, offset)
         os.search_terms = selections
         instance_filter = HTMLFormFiller(data=params)
         rendered = self.formatter.render('advresults', os, instance_filter)
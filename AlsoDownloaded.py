@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+#  -*- mode: python; indent-tabs-mode: nil; -*- coding: utf-8 -*-
+
+"""
+AlsoDownloaded.py
+
+Distributable under the GNU General Public License Version 3 or newer.
+
+Precomputed "Readers also downloaded" lists.
+
+Counting the co-downloads of a book in scores.also_downloads is one
+of our most expensive queries. This module precomputes the top
+co-downloaded books of every book into scores.also_downloads_top (see:
+sql/also_downloads_top.sql) and keeps an in-memory copy of that table
+for the app server.
+
+Usage:
+  python AlsoDownloaded.py      # (re)build the table, eg. nightly
+
+  import AlsoDownloaded
+  AlsoDownloaded.load ()        # in the timer thread
+  AlsoDownloaded.lookup (pk)    # in the request thread
+
+"""
+
+from __future__ import unicode_literals
+
+import array
+import logging
+import time
+
+import cherrypy
+
+import ConnectionPool
+
+TOP_N = 25
+""" How many co-downloaded books to keep per book. One page full. """
+
+RELOAD_INTERVAL = 3600 # seconds
+
+index = {}
+""" Book pk => (array of pks, array of download counts) """
+
+loaded = 0.0
+""" When index was last loaded. """
+
+
+BUILD_SQL = """
+INSERT INTO scores.also_downloads_top_new (fk_books, pks, dls)
+SELECT fk_books,
+       array_agg (pk ORDER BY rank),
+       array_agg (dl ORDER BY rank)
+FROM (
+  SELECT s2.fk_books,
+         s1.fk_books AS pk,
+         count (s1.id) AS dl,
+         row_number () OVER (
+           PARTITION BY s2.fk_books
+           ORDER BY count (s1.id) DESC, s1.fk_books) AS rank
+  FROM scores.also_downloads AS s1
+    JOIN scores.also_downloads AS s2 ON s1.id = s2.id
+  WHERE s1.fk_books != s2.fk_books
+  GROUP BY s2.fk_books, s1.fk_books) AS ranked
+WHERE rank <= %(top_n)s
+GROUP BY fk_books
+"""
+
+
+def build (conn, top_n = TOP_N):
+    """ Rebuild scores.also_downloads_top.
+
+    The new table is built aside and swapped in, so readers never
+    see it empty.
+
+    """
+
+    c = conn.cursor ()
+    c.execute ("DROP TABLE IF EXISTS scores.also_downloads_top_new")
+    c.execute ("CREATE TABLE scores.also_downloads_top_new "
+               "(LIKE scores.also_downloads_top INCLUDING ALL)")
+    c.execute (BUILD_SQL, { 'top_n': top_n })
+    c.execute ("DROP TABLE scores.also_downloads_top")
+    c.execute ("ALTER TABLE scores.also_downloads_top_new RENAME TO also_downloads_top")
+    c.execute ("GRANT SELECT ON scores.also_downloads_top TO PUBLIC")
+    conn.commit ()
+
+
+def load ():
+    """ Load the precomputed table into memory.
+
+    Does nothing if the index was loaded less than RELOAD_INTERVAL ago.
+    Return True on success.
+
+    """
+
+    global index, loaded
+
+    if time.time () - loaded < RELOAD_INTERVAL:
+        return True
+    # if the table is missing, try again next interval
+    loaded = time.time ()
+
+    conn = cherrypy.engine.pool.connect ()
+    c = conn.cursor ()
+    try:
+        c.execute (ConnectionPool.NO_TIMEOUT)
+        c.execute ("SELECT fk_books, pks, dls FROM scores.also_downloads_top")
+    except Exception as what:
+        cherrypy.log ("Cannot load also_downloads_top: %s" % what,
+                      context = 'ENGINE', severity = logging.WARNING)
+        conn.rollback ()
+        return False
+
+    new_index = {}
+    for fk_books, pks, dls in c:
+        new_index[fk_books] = (array.array ('i', pks), array.array ('i', dls))
+
+    # replace, don't update, so readers never see a half-loaded index
+    index = new_index
+    return True
+
+
+def lookup (pk, rows = TOP_N):
+    """ Return the co-downloaded books of pk as (pks, download counts)
+    or None if the book is not in the index.
+
+    Also returns None if the caller needs more than the first TOP_N
+    rows and the list got cut there.
+
+    """
+
+    top = index.get (pk)
+    if top is not None and rows > len (top[0]) >= TOP_N:
+        return None
+    return top
+
+
+def main ():
+    """ Rebuild the table using the app server config. """
+
+    import psycopg2
+    from libgutenberg import GutenbergDatabase
+    import CherryPyApp
+
+    cherrypy.config.update (CherryPyApp.CHERRYPY_CONFIG)
+    for config_filename in CherryPyApp.LOCAL_CONFIG:
+        try:
+            cherrypy.config.update (config_filename)
+            break
+        except IOError:
+            pass
+
+    conn = psycopg2.connect (**GutenbergDatabase.get_connection_params (cherrypy.config))
+    build (conn)
+
+
+if __name__ == '__main__':
+    main ()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+#  -*- mode: python; indent-tabs-mode: nil; -*- coding: utf-8 -*-
+
+"""
+AuthorStats.py
+
+Distributable under the GNU General Public License Version 3 or newer.
+
+Number of books by each author, for the breadcrumbs of the bibrec
+page.
+
+The counts of all authors are loaded with one grouped query when the
+catalog changes. Until then the counts of the authors asked for are
+queried, also with one grouped query.
+
+Usage:
+  import AuthorStats
+  AuthorStats.load ()                  # in the timer thread
+  AuthorStats.book_counts ([1, 2])     # in the request thread
+
+"""
+
+from __future__ import unicode_literals
+
+import logging
+
+import cherrypy
+
+import ConnectionPool
+
+SQL = "SELECT fk_authors, count (*) FROM mn_books_authors %s GROUP BY fk_authors"
+
+counts = None
+""" Author id => number of books, or None if not loaded """
+
+
+def load ():
+    """ (Re)load the counts of all authors. Return True on success. """
+
+    global counts
+
+    conn = cherrypy.engine.pool.connect ()
+    c = conn.cursor ()
+    try:
+        c.execute (ConnectionPool.NO_TIMEOUT)
+        c.execute (SQL % '')
+        new_counts = dict (c.fetchall ())
+    except Exception as what:
+        cherrypy.log ("Cannot load author stats: %s" % what,
+                      context = 'ENGINE', severity = logging.WARNING)
+        conn.rollback ()
+        return False
+
+    counts = new_counts
+    return True
+
+
+def book_counts (ids):
+    """ Return a dict of author id => number of books for ids. """
+
+    if counts is not None:
+        return dict ((id_, counts.get (id_, 0)) for id_ in ids)
+
+    ids = list (ids)
+    if not ids:
+        return {}
+    conn = cherrypy.engine.pool.connect ()
+    c = conn.cursor ()
+    c.execute (SQL % 'WHERE fk_authors = ANY (%(ids)s)', { 'ids': ids })
+    result = dict ((id_, 0) for id_ in ids)
+    result.update (c.fetchall ())
+    return result
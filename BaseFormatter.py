@@ -23,10 +23,12 @@ from six.moves import urllib
 from genshi.core import _ensure
 from genshi.core import escape, Markup, QName
 from genshi.core import START, END, TEXT, XML_DECL, DOCTYPE, START_CDATA, END_CDATA, PI, COMMENT
+import genshi.filters
 import genshi.output
 from genshi.output import EMPTY, EmptyTagFilter, WhitespaceFilter, \
                           NamespaceFlattener, DocTypeInserter
 import genshi.template
+from genshi.template.base import EXEC, EXPR, INCLUDE, SUB
 
 
 import cherrypy
@@ -42,6 +44,87 @@ WHITESPACE_FILTER = genshi.output.WhitespaceFilter()
 
 DATA_URL_CACHE = {}
 
+
+def is_static(stream):
+    """ Does the template stream render the same in any context? """
+
+    for kind, data, dummy_pos in stream:
+        if kind in (EXPR, EXEC, SUB, INCLUDE):
+            return False
+        if kind is START and not all(isinstance(value, str) for dummy_name, value in data[1]):
+            return False
+    return True
+
+
+def splice_fragments(stream, fragments, serializer):
+    """ Replace the events inlined from the templates in fragments
+    with their serialized markup. """
+
+    spliced = []
+    run = []
+    for event in stream + [(None, None, None)]:
+        kind, data, pos = event
+        if kind is not SUB and pos and pos[0] in fragments:
+            run.append(event)
+            continue
+        if run:
+            markup = ''.join(serializer(_ensure(
+                WHITESPACE_FILTER(iter(run), collapse_lines=COLLAPSE_LINES))))
+            spliced.append((TEXT, Markup(markup), run[0][2]))
+            run = []
+        if kind is SUB:
+            directives, substream = data
+            event = kind, (directives, splice_fragments(substream, fragments, serializer)), pos
+        if kind is not None:
+            spliced.append(event)
+    return spliced
+
+
+def pretranslated(template, translations, serializer=None):
+    """ Load a copy of template with the translations baked in.
+
+    The texts and attributes get translated once here instead of on
+    every render. Only i18n:msg elements, which contain expressions,
+    are left to be translated at render time.
+
+    If a serializer is given, the static includes, like the menu and
+    the footer, are serialized here and spliced into the stream as
+    markup.
+    """
+
+    translator = genshi.filters.Translator(translations)
+    loaded = []
+
+    def setup(tmpl):
+        """ Loader callback. """
+        translator.setup(tmpl)
+        loaded.append(tmpl)
+
+    loader = genshi.template.TemplateLoader(os.path.dirname(template.filepath), callback=setup)
+    variant = loader.load(template.filename)
+
+    # the static includes are inlined into variant.stream by now
+    variant._stream = list(translator(variant.stream))
+    variant.filters.remove(translator)
+
+    if serializer is not None:
+        fragments = set()
+        for tmpl in loaded:
+            if tmpl is not variant and is_static(tmpl.stream):
+                # the events carry either name
+                fragments.update((tmpl.filepath, tmpl.filename))
+        if fragments:
+            variant._stream = splice_fragments(variant._stream, fragments, serializer)
+
+    def msg_gettext(stream, ctxt, **dummy_vars):
+        """ The gettext for i18n:msg. """
+        ctxt['_i18n.gettext'] = translations.gettext
+        return stream
+
+    variant.filters.insert(0, msg_gettext)
+    return variant
+
+
 class BaseFormatter(object):
     """ Base class for formatters. """
 
@@ -49,6 +132,7 @@ class BaseFormatter(object):
 
     def __init__(self):
         self.templates = {}
+        self.variants = {}
 
 
     def format(self, page, os):
@@ -66,6 +150,15 @@ class BaseFormatter(object):
         pass
 
 
+    def get_fragment_serializer(self):
+        """ The serializer for page fragments: no doctype. """
+
+        serializer = self.get_serializer()
+        serializer.filters = [filter_ for filter_ in serializer.filters
+                              if not isinstance(filter_, DocTypeInserter)]
+        return serializer
+
+
     def send_headers(self):
         """ Send HTTP content-type header. """
         cherrypy.response.headers['Content-Type'] = self.CONTENT_TYPE
@@ -76,7 +169,7 @@ class BaseFormatter(object):
 
         self.send_headers()
 
-        template = self.templates[page]
+        template = self.get_template(page)
         ctxt = genshi.template.Context(cherrypy=cherrypy, os=os, bs=BaseSearcher)
 
         stream = template.stream
@@ -98,6 +191,20 @@ class BaseFormatter(object):
 
         Override this for special handling of template, like adding filters. """
         self.templates[page] = template
+        for key in [key for key in self.variants if key[0] == page]:
+            del self.variants[key]
+
+
+    def get_template(self, page):
+        """ Get the template for page in the language of the request. """
+
+        i18n = cherrypy.response.i18n
+        key = (page, i18n.language)
+        template = self.variants.get(key)
+        if template is None:
+            template = self.variants[key] = pretranslated(
+                self.templates[page], i18n.trans, self.get_fragment_serializer())
+        return template
 
 
     @staticmethod
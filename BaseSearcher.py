@@ -15,14 +15,18 @@ Base class
 from __future__ import unicode_literals
 from __future__ import division
 
+import base64
+import concurrent.futures
+import copy
 import datetime
+import hashlib
+import json
 import logging
 
 from six.moves import urllib
 import cherrypy
 import routes
 import babel
-import regex  # module re does not support \p{L}
 import six
 
 from libgutenberg.MediaTypes import mediatypes as mt
@@ -34,7 +38,10 @@ from libgutenberg import GutenbergGlobals as gg
 from i18n_tool import ugettext as _
 from i18n_tool import ungettext as __
 
+import Caches
 import DublinCoreI18n
+import InvertedIndex
+import QueryCompiler
 from SupportedLocales import FB_LANGS, TWITTER_LANGS, GOOGLE_LANGS, PAYPAL_LANGS
 
 VALID_PROTOCOLS = ('http', 'https')
@@ -56,6 +63,17 @@ USER_SORT_ORDERS = 'downloads author release_date title alpha quantity nentry ra
 # internally used sort orders
 SORT_ORDERS = USER_SORT_ORDERS + 'nentry'.split()
 
+# sort key and direction of the sort orders that support keyset pagination
+# pk is always the tie-breaker, see: SQLStatement.build ()
+KEYSET_SORT_KEYS = {
+    'downloads':    ('downloads',    'DESC'),
+    'release_date': ('release_date', 'DESC'),
+    'quantity':     ('quantity',     'DESC'),
+    'title':        ('filing',       'ASC'),
+    'alpha':        ('title',        'ASC'),
+    'author':       ('author',       'ASC'),
+}
+
 # fk_categories of sound files
 AUDIOBOOK_CATEGORIES = set([1, 2, 3, 6])
 
@@ -101,6 +119,81 @@ class ClassAttr(object):
         return b in self.value
 
 
+DC_SQL = """
+SELECT ids.pk, books.pk IS NOT NULL AS found,
+       books.copyrighted, books.release_date, books.downloads,
+
+  (SELECT json_agg(json_build_object(
+            'pk', authors.pk, 'author', author,
+            'born_floor', born_floor, 'born_ceil', born_ceil,
+            'died_floor', died_floor, 'died_ceil', died_ceil,
+            'fk_roles', fk_roles, 'role', role, 'heading', heading,
+            'aliases', (SELECT json_agg(json_build_object(
+                                 'alias', alias, 'alias_heading', alias_heading))
+                          FROM aliases WHERE fk_authors = authors.pk),
+            'webpages', (SELECT json_agg(json_build_object(
+                                  'description', description, 'url', url))
+                           FROM author_urls WHERE fk_authors = authors.pk))
+          ORDER BY heading, role, author)
+     FROM mn_books_authors
+     JOIN authors ON mn_books_authors.fk_authors = authors.pk
+     JOIN roles   ON mn_books_authors.fk_roles   = roles.pk
+    WHERE mn_books_authors.fk_books = ids.pk) AS authors,
+
+  (SELECT json_agg(json_build_object(
+            'text', attributes.text, 'nonfiling', attributes.nonfiling,
+            'name', attriblist.name, 'caption', attriblist.caption)
+          ORDER BY attriblist.name)
+     FROM attributes, attriblist
+    WHERE attributes.fk_books = ids.pk
+      AND attributes.fk_attriblist = attriblist.pk) AS marcs,
+
+  (SELECT json_agg(json_build_object('pk', pk, 'lang', lang))
+     FROM langs, mn_books_langs
+    WHERE langs.pk = mn_books_langs.fk_langs
+      AND mn_books_langs.fk_books = ids.pk) AS languages,
+
+  (SELECT json_agg(json_build_object('pk', pk, 'subject', subject))
+     FROM subjects, mn_books_subjects
+    WHERE subjects.pk = mn_books_subjects.fk_subjects
+      AND mn_books_subjects.fk_books = ids.pk) AS subjects,
+
+  (SELECT json_agg(json_build_object('pk', pk, 'bookshelf', bookshelf))
+     FROM bookshelves, mn_books_bookshelves
+    WHERE bookshelves.pk = mn_books_bookshelves.fk_bookshelves
+      AND mn_books_bookshelves.fk_books = ids.pk) AS bookshelves,
+
+  (SELECT json_agg(json_build_object('pk', pk, 'locc', locc))
+     FROM loccs, mn_books_loccs
+    WHERE loccs.pk = mn_books_loccs.fk_loccs
+      AND mn_books_loccs.fk_books = ids.pk) AS loccs,
+
+  (SELECT json_agg(json_build_object('dcmitype', dcmitype, 'description', description))
+     FROM dcmitypes, mn_books_categories
+    WHERE dcmitypes.pk = mn_books_categories.fk_categories
+      AND fk_books = ids.pk) AS categories,
+
+  (SELECT json_agg(json_build_object(
+            'pk', files.pk, 'filename', filename, 'filetype', filetype,
+            'mediatype', mediatype, 'filesize', filesize,
+            'filemtime', to_char(filemtime, 'YYYY-MM-DD"T"HH24:MI:SS.US'),
+            'fk_filetypes', fk_filetypes, 'fk_encodings', fk_encodings,
+            'fk_compressions', fk_compressions, 'generated', generated)
+          ORDER BY filetypes.sortorder, encodings.sortorder, fk_filetypes,
+                   fk_encodings, fk_compressions, filename)
+     FROM files
+     LEFT JOIN filetypes ON (files.fk_filetypes = filetypes.pk)
+     LEFT JOIN encodings ON (files.fk_encodings = encodings.pk)
+    WHERE fk_books = ids.pk
+      AND obsoleted = 0
+      AND diskstatus = 0) AS files
+
+FROM unnest(%(pks)s::integer[]) AS ids(pk)
+LEFT JOIN books ON books.pk = ids.pk
+"""
+""" The whole DublinCore record of many books in one statement, see: DC.load_many () """
+
+
 class DC(GutenbergDatabaseDublinCore.GutenbergDatabaseDublinCore,
           DublinCoreI18n.DublinCoreI18nMixin):
     """ A localized DublinCore. """
@@ -108,6 +201,193 @@ class DC(GutenbergDatabaseDublinCore.GutenbergDatabaseDublinCore,
     def __init__(self, pool):
         GutenbergDatabaseDublinCore.GutenbergDatabaseDublinCore.__init__(self, pool)
         DublinCoreI18n.DublinCoreI18nMixin.__init__(self)
+        self.stamp = None
+
+
+    @classmethod
+    def load_many(cls, pool, ids):
+        """ Load the DCs of many books in one statement.
+
+        An alternative to load_from_database () that fills the same
+        attributes. Returns a dict of id => DC.
+        """
+        conn = pool.connect()
+        c = conn.cursor()
+        c.execute(DC_SQL, {'pks': list(ids)})
+        dcs = {}
+        for row in c.fetchall():
+            dc = cls(pool)
+            dc.fill(xl(c, row))
+            dcs[dc.project_gutenberg_id] = dc
+        return dcs
+
+
+    def fill(self, row):
+        """ Fill from a row of DC_SQL, like load_from_database () would. """
+
+        def struct(**kwargs):
+            s = gg.Struct()
+            s.__dict__.update(kwargs)
+            return s
+
+        self.project_gutenberg_id = id_ = row.pk
+
+        if row.found:
+            self.release_date = row.release_date
+            self.rights = ('Copyrighted. Read the copyright notice inside this book for details.'
+                           if row.copyrighted
+                           else 'Public domain in the USA.')
+            self.downloads = row.downloads
+
+        for a in row.authors or []:
+            author = struct(
+                id=a['pk'], name=a['author'], marcrel=a['fk_roles'], role=a['role'],
+                heading=a['heading'], birthdate=a['born_floor'], deathdate=a['died_floor'],
+                birthdate2=a['born_ceil'], deathdate2=a['died_ceil'])
+            author.aliases = [struct(alias=alias['alias'], heading=alias['alias_heading'])
+                              for alias in a['aliases'] or []]
+            author.webpages = [struct(description=webpage['description'], url=webpage['url'])
+                               for webpage in a['webpages'] or []]
+            author.name_and_dates = \
+                DublinCore.GutenbergDublinCore.format_author_date(author)
+            first_let_match = GutenbergDatabaseDublinCore.RE_FIRST_AZ.search(
+                author.name_and_dates.lower())
+            # sic, like load_from_database ()
+            author.first_lettter = first_let_match.group(0) if first_let_match else 'other'
+            self.authors.append(author)
+
+        for m in row.marcs or []:
+            marc = struct(code=m['name'].split(' ')[0],
+                          text=self.strip_marc_subfields(m['text']),
+                          caption=m['caption'])
+            self.marcs.append(marc)
+            if marc.code == '245':
+                self.title = marc.text
+                self.title_file_as = marc.text[m['nonfiling']:]
+                self.title_file_as = self.title_file_as[0].upper() + self.title_file_as[1:]
+            elif marc.code == '508':
+                marc.text = DublinCore.RE_UPDATE.split(marc.text)[0].strip()
+
+        for lang in row.languages or [{'pk': 'en', 'lang': 'English'}]:
+            self.languages.append(struct(id=lang['pk'], language=lang['lang']))
+        for subject in row.subjects or []:
+            self.subjects.append(struct(id=subject['pk'], subject=subject['subject']))
+        for bookshelf in row.bookshelves or []:
+            self.bookshelves.append(struct(id=bookshelf['pk'], bookshelf=bookshelf['bookshelf']))
+        for locc in row.loccs or []:
+            self.loccs.append(struct(id=locc['pk'], locc=locc['locc']))
+        for category in row.categories or [{'dcmitype': 'Text', 'description': 'Text'}]:
+            self.categories.append(category['dcmitype'])
+            self.dcmitypes.append(struct(id=category['dcmitype'],
+                                         description=category['description']))
+
+        # like load_files_from_database ()
+        self.new_filesystem = False
+        self.mediatypes = set()
+        self.filetypes = set()
+        self.files = []
+        self.generated_files = []
+        adir = gg.archive_dir(id_)
+        for f in row.files or []:
+            fn = f['filename']
+            file_ = struct(archive_path=fn)
+            if fn.startswith(adir):
+                fn = fn.replace(adir, 'files/%d' % id_)
+                self.new_filesystem = True
+            elif fn.startswith('etext'):
+                fn = 'dirs/' + fn
+
+            file_.filename    = fn
+            file_.url         = gg.PG_URL + fn
+            file_.id          = f['pk']
+            file_.extent      = f['filesize']
+            file_.hr_extent   = self.human_readable_size(f['filesize'])
+            file_.modified    = (datetime.datetime.fromisoformat(f['filemtime'])
+                                 if f['filemtime'] else None)
+            file_.filetype    = f['fk_filetypes']
+            file_.hr_filetype = f['filetype']
+            file_.encoding    = f['fk_encodings']
+            file_.compression = f['fk_compressions']
+            file_.generated   = f['generated']
+
+            if f['filetype']:
+                self.filetypes.add(f['filetype'])
+
+            file_.mediatypes = [gg.DCIMT(f['mediatype'], f['fk_encodings'])]
+            if file_.compression == 'zip':
+                file_.mediatypes.append(gg.DCIMT('application/zip'))
+
+            if file_.generated and not f['fk_filetypes'].startswith('cover.'):
+                file_.url = "%sebooks/%d.%s" % (gg.PG_URL, id_, f['fk_filetypes'])
+
+            self.files.append(file_)
+
+            if f['mediatype']:
+                self.mediatypes.add(f['mediatype'])
+
+
+    def view(self):
+        """ Return a copy that can be translated and mutated.
+
+        Copies the lists and sets and the items in the lists, which
+        is what translate () and the formatters touch, but nothing
+        deeper.
+        """
+        dc = copy.copy(self)
+        for name, value in vars(self).items():
+            if isinstance(value, list):
+                setattr(dc, name, [copy.copy(item) if hasattr(item, '__dict__') else item
+                                   for item in value])
+            elif isinstance(value, set):
+                setattr(dc, name, set(value))
+        return dc
+
+
+DC_CACHE_SIZE = 64 * 1024 * 1024
+""" Default size of the 'dc' cache in bytes. DCs vary a lot in size,
+so the cache is bounded by size, not by number of entries. """
+
+
+def dc_size(dc):
+    """ Return the approximate size of a cached DC in bytes. """
+    # the pool is shared by all DCs
+    return Caches.approx_size(dc, {id(getattr(dc, 'pool', None))})
+
+
+def dc_cache():
+    """ Return the 'dc' cache. """
+    return Caches.get('dc', DC_CACHE_SIZE, weigh=dc_size)
+
+
+def get_dc(id_, stamp=None):
+    """ Return the DC of book id_, for use in this request only.
+
+    Loaded DCs are kept, untranslated, in the 'dc' cache shared by
+    all threads. Pass a stamp, eg. the files' mtime, to reload the DC
+    when the stamp changed.
+    """
+    cache = dc_cache()
+    snapshot = cache.get(id_)
+    if snapshot is None or (stamp is not None and snapshot.stamp != stamp):
+        snapshot = DC.load_many(cherrypy.engine.pool, [id_])[id_]
+        snapshot.stamp = stamp
+        cache.put(id_, snapshot)
+    return snapshot.view()
+
+
+def get_dcs(ids):
+    """ Return the DCs of books ids, in order, like get_dc ().
+
+    Loads all DCs not in the cache in one statement.
+    """
+    cache = dc_cache()
+    snapshots = {id_: cache.get(id_) for id_ in ids}
+    missing = [id_ for id_, snapshot in snapshots.items() if snapshot is None]
+    if missing:
+        for id_, snapshot in DC.load_many(cherrypy.engine.pool, missing).items():
+            cache.put(id_, snapshot)
+            snapshots[id_] = snapshot
+    return [snapshots[id_].view() for id_ in ids]
 
 
 class Cat(object):
@@ -147,38 +427,10 @@ class SearchUrlFormatter(object):
 class SQLStatement(object):
     """ Class implementing an SQL statement. """
 
-    prefix_to_prefix = {
-        'a.': 'ax',
-        't.': 'tx',
-        's.': 'sx',
-        'bs.': 'bsx',
-        'l.': 'l0',
-        '#': 'no.',
-        'n.': 'no.',
-        'type.': 'y0',
-        'lcn.': 'lcnx',
-        'lcc.': 'lcc0',
-        'cat.': 'cat0',
-    }
-    """Dict of user-visible prefixes to translate.
-
-    User-visible prefixes must be easy to type. The dot is on the
-    lowercase keyboard of most phones, so you need no shifting to type
-    these.
-
-    Internal prefixes exploit the quirks of the tsvec stemmer. Words
-    containing numbers do not get stemmed, so any '*0' prefix searches
-    for the unstemmed word. All other words get stemmed, so any '*x'
-    prefix searches for the stem of the word. 'x' was selected because
-    it is a rare character that will cause few false positives.
-
-    """
-
-    regex_cache = {}
-    """ Cache of compiled regexes. """
-
     def __init__(self):
         self.query = ''
+        self.columns = []
+        self.fulltexts = [] # (field, stemmer, tsquery) for alternative backends
         self.params = {}
         self.from_ = []
         self.where = []
@@ -186,109 +438,43 @@ class SQLStatement(object):
         self.sort_order = None
         self.start_index = 1
         self.items_per_page = -1
+        self.cursor = None # (key, pk) of the last row on the previous page
 
 
-    @classmethod
-    def sub(cls, regex_, replace, query):
-        """ Like re.sub but also compile and cache the regex. """
-        if not isinstance(query, str):
-            query = query[0] if isinstance(query, list) and len(query) > 0 else ''
-
-        cregex = cls.regex_cache.setdefault(
-            regex_, regex.compile(regex_, regex.UNICODE | regex.VERSION1))
-        return cregex.sub(replace, query)
-
-
-    @classmethod
-    def preprocess_query(cls, query):
+    @staticmethod
+    def preprocess_query(query):
         """ Preprocess query.
 
         The preprocessed query might get echoed to the user.
         """
 
-        sub = cls.sub
+        return QueryCompiler.compile_query(query).echo
 
-        # strip most not (letter or digit)
-        # \p{Z} : Separator
-        # \p{P} : Punctuation
-        # \p{S} : Symbol
-        # \p{M} : Mark
-        # \p{C} : Other
 
-        query = sub(r'[\p{Z}\p{P}\p{S}\p{M}\p{C}--.!|()#]', ' ', query)
+    @staticmethod
+    def translate_query(query):
+        """ Translate query from user syntax to postgres tsvec syntax. """
 
-        # strip operators adjacent to non-whitespace
-        # if you want grouping you have to add space on both sides of the parens
-        query = sub(r'\b[!)]', ' ', query)
-        query = sub(r'[(]\b', ' ', query)
+        return QueryCompiler.compile_query(query).tsquery
 
-        # insert spaces around operators
-        query = sub(r'\s*[|!()]\s*', r' \g<0> ', query)
 
-        # remove empty groups
-        query = sub(r'\s*\([.!|()#\s]+\)\s*', ' ', query)
-        return ' '.join(query.split())
+    def digest(self):
+        """ Return a hash of what the statement selects, paging aside.
 
+        Call this before build(), which adds the paging parameters.
 
-    @classmethod
-    def translate_query(cls, query):
-        """ Translate query from user syntax to postgres tsvec syntax. """
-
-        sub = cls.sub
-
-        def prefix_sub(match_object):
-            """ Translate from user-visible prefix to internal prefix. """
-            s = match_object.group(0)
-            return cls.prefix_to_prefix.get(s, s)
-
-        def balance(query):
-            """ Balance parens. """
-            def scan(query, up, down):
-                scan = ''
-                depth = 0
-                for char in query:
-                    if char == up:
-                        depth += 1
-                        scan += char
-                    elif char == down:
-                        depth += -1
-                        if depth < 0:
-                            depth = 0
-                        else:
-                            scan += char
-                    else:
-                        scan += char
-                return scan, depth
-            balanced, depth = scan(query, '(', ')')
-            if depth:
-                balanced, depth = scan(balanced[::-1], ')', '(')
-                balanced = balanced[::-1]
-            return balanced
-
-        # Replace the user-visible prefixes with the internally used prefixes.
-        query = sub(r'(\b\w+\.|#)(?=\w)', prefix_sub, query)
-
-        # add wildcards to all words
-        query = sub(r'\b(\p{L}+)(\s|$)', r'\1:*\2', query)
-        query = query.replace('. ', ' ')
-
-        # if parens aren't balanced, remove them
-        query = balance(query)
-
-        # if ! or | are at the wrong ends, remove them
-        query = sub(r'(^[ \|]+|[ \|\!]+$)', '', query)
-
-        # replace ' ' with ' & '
-        query = ' '.join(query.split())
-        query = sub(r'(?<![|!(\s])\s+(?![|)])', ' & ', query)
-
-        return query
+        """
+        data = repr((self.query, self.columns, self.from_, self.where, self.groupby,
+                     sorted(self.params.items())))
+        return hashlib.sha1(data.encode('utf-8')).hexdigest()[:16]
 
 
     def build(self):
         """ Returns the SQL query string and parameter array. """
 
         query = self.query
+        if not query:
+            query = "SELECT " + (", ".join(self.columns) or "*")
 
         if self.from_:
             query += " FROM " + ", ".join(self.from_)
@@ -301,21 +487,37 @@ class SQLStatement(object):
 
         params = self.params
 
+        order_by = ''
         if self.sort_order in SORT_ORDERS:
-            if self.sort_order == 'random':
-                query += " ORDER BY random ()"
-            elif self.sort_order == 'title':
-                query += " ORDER BY filing"
-            elif self.sort_order == 'alpha':
-                query += " ORDER BY title"
-            elif self.sort_order == 'author':
-                query += " ORDER BY author"
-            elif self.sort_order == 'release_date':
-                query += " ORDER BY release_date DESC, pk DESC"
+            if self.sort_order in KEYSET_SORT_KEYS:
+                # pk makes the order total, which keyset pagination needs
+                column, direction = KEYSET_SORT_KEYS[self.sort_order]
+                order_by = " ORDER BY %s %s, pk %s" % (column, direction, direction)
+            elif self.sort_order == 'random':
+                order_by = " ORDER BY random ()"
             else:
-                query += " ORDER BY %s DESC" % (self.sort_order)
+                order_by = " ORDER BY %s DESC" % (self.sort_order)
+
+        keyset = self.cursor is not None and self.sort_order in KEYSET_SORT_KEYS
+        if keyset:
+            # keyset pagination: seek past the last row of the previous page
+            # instead of making postgres produce and throw away all rows
+            # before the offset
+            column, direction = KEYSET_SORT_KEYS[self.sort_order]
+            params['cursor_key'], params['cursor_pk'] = self.cursor
+            if direction == 'DESC':
+                # NULLs sort first in descending order
+                seek = "(%s, pk) < (%%(cursor_key)s, %%(cursor_pk)s)" % column
+            else:
+                # NULLs sort last in ascending order
+                seek = "((%s, pk) > (%%(cursor_key)s, %%(cursor_pk)s) OR %s IS NULL)" % (
+                    column, column)
+            # wrap the query, so we can seek on aggregates too
+            query = "SELECT * FROM (%s) AS keyset WHERE %s" % (query, seek)
+
+        query += order_by
 
-        if self.start_index > 1:
+        if self.start_index > 1 and not keyset:
             # opensearch is 1-based, SQL is 0-based
             params['offset'] = self.start_index - 1
             query += " OFFSET %(offset)s"
@@ -358,6 +560,7 @@ class SQLStatement(object):
 
         self.where.append("%s @@ to_tsquery('%s', %%(p%d)s)" %
                            (field, stemmer, len(self.params)))
+        self.fulltexts.append((field, stemmer, query))
 
         self.params['p%d' % len(self.params)] = query
 
@@ -391,6 +594,9 @@ class OpenSearch(object):
         self.start_index = 1
         self.items_per_page = 1
         self.total_results = -1
+        self.cursor = None
+        self.next_page_cursor = None
+        self.query_digest = None # the search the cursors are good for
         self.page_mode = 'screen'
         self.user_dialog = ('', '')
         self.opensearch_support = 0 # 0 = none, 1 = full, 2 = fake(Stanza, Aldiko, ...)
@@ -413,7 +619,7 @@ class OpenSearch(object):
         self.user_agent = cherrypy.request.headers.get('User-Agent', '')
 
         cherrypy.request.os = self
-        s = cherrypy.session
+        s = session()
         k = cherrypy.request.params
 
         host = cherrypy.request.headers.get('X-Forwarded-Host', cherrypy.config['host'])
@@ -461,6 +667,10 @@ class OpenSearch(object):
         except (ValueError, TypeError) as what:
             self.items_per_page = 25
 
+        # cursor: opaque keyset pagination token, see: encode_cursor()
+        cursor = k.get('cursor')
+        if isinstance(cursor, six.string_types):
+            self.cursor = cursor
 
         self.file_host = cherrypy.config['file_host']
         self.now = datetime.datetime.utcnow().replace(microsecond = 0).isoformat() + 'Z'
@@ -556,6 +766,10 @@ class OpenSearch(object):
         self.next_page_index = min(self.start_index + self.items_per_page, self.total_results)
         self.last_page_index = last_page * self.items_per_page + 1
 
+        # the cursor is only good for the row right after this page
+        if self.next_page_index != self.start_index + self.items_per_page:
+            self.next_page_cursor = None
+
         self.show_prev_page_link = self.start_index > 1
         self.show_next_page_link = (self.end_index < self.total_results)
 
@@ -570,7 +784,7 @@ class OpenSearch(object):
 
         self.osd_url = self.qualify('/catalog/osd-books.xml')
 
-        s = cherrypy.session
+        s = session()
         # write this late so pages can change it
         s['search_terms'] = self.search_terms
 
@@ -618,6 +832,8 @@ class OpenSearch(object):
             del d['fb_locale']
         except KeyError:
             pass
+        # a cursor is only valid for the next page, pass it explicitly
+        d.pop('cursor', None)
         d.update(kwargs)
         return d
 
@@ -863,6 +1079,16 @@ class OpenSearch(object):
 
 
 
+def session():
+    """ Return the session of this request.
+
+    Return a throwaway dict if sessions are off, eg. in Prerender.py.
+
+    """
+    s = getattr(cherrypy.serving, 'session', None)
+    return {} if s is None else s
+
+
 def sql_get(query, **params):
     """ Quick and dirty SQL query returning one value. """
     conn = cherrypy.engine.pool.connect()
@@ -882,6 +1108,92 @@ def sql_get(query, **params):
         raise
 
 
+def encode_cursor(digest, sort_order, start_index, key, pk):
+    """ Encode the position of a row into an opaque keyset pagination token.
+
+    The token is only valid for the same search, see: SQLStatement.digest(),
+    sort order and start_index.
+
+    """
+    data = json.dumps([digest, sort_order, start_index, key, pk],
+                      default=str, separators=(',', ':'))
+    return base64.urlsafe_b64encode(data.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor, digest, sort_order, start_index):
+    """ Decode a token made by encode_cursor().
+
+    Return a (key, pk) tuple or None if the token is bogus or stale.
+
+    """
+    if not cursor or sort_order not in KEYSET_SORT_KEYS:
+        return None
+    try:
+        data = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        cursor_digest, cursor_sort_order, cursor_start_index, key, pk = json.loads(
+            data.decode('utf-8'))
+    except (ValueError, TypeError):
+        return None
+
+    if (cursor_digest != digest or cursor_sort_order != sort_order
+            or cursor_start_index != start_index):
+        return None
+    if not isinstance(pk, int) or isinstance(pk, bool):
+        return None
+    if isinstance(key, list):
+        if not all(isinstance(k, six.string_types) for k in key):
+            return None
+    elif isinstance(key, bool) or not isinstance(key, (six.string_types, int, float)):
+        return None
+    return key, pk
+
+
+class ParallelQueries(object):
+    """ Run the independent queries of one request concurrently.
+
+    Each query runs in the shared thread pool of cherrypy.engine.pool
+    on a connection of its own. If the pool has no spare connections
+    the query runs immediately in the request thread instead.
+
+    The submitted functions must not use cherrypy.request or
+    cherrypy.response, because they may run in another thread.
+
+    Usage:
+      os.queries.submit('urls', SQLSearcher.execute, query, params)
+      ...
+      rows = os.queries.result('urls')
+
+    """
+
+    spare_connections = 2
+    """ Connections to leave for other requests. """
+
+    def __init__(self):
+        self.futures = {}
+
+
+    def submit(self, name, func, *args):
+        """ Start func(*args). Get its return value with result(name). """
+
+        pool = cherrypy.engine.pool
+        if pool.executor is not None and pool.spare_connections() > self.spare_connections:
+            self.futures[name] = pool.executor.submit(func, *args)
+            return
+
+        future = concurrent.futures.Future()
+        try:
+            future.set_result(func(*args))
+        except Exception as what:
+            future.set_exception(what)
+        self.futures[name] = future
+
+
+    def result(self, name):
+        """ Wait for query name and return its result or raise its exception. """
+
+        return self.futures.pop(name).result()
+
+
 class SQLSearcher(object):
     """ An SQL searcher. """
 
@@ -896,10 +1208,43 @@ class SQLSearcher(object):
         sql.sort_order = os.sort_order
         sql.start_index = os.start_index
         sql.items_per_page = os.items_per_page
+        os.query_digest = sql.digest()
+        sql.cursor = decode_cursor(os.cursor, os.query_digest, os.sort_order, os.start_index)
+
+        rows = InvertedIndex.search(sql)
+        if rows is None:
+            rows = self.sql_search(os, sql)
+
+        return self.format_rows(os, rows)
+
+
+    def sql_search(self, os, sql):
+        """ Perform the SQL query and return the rows. """
+
         query, params = sql.build()
-        query += ' -- ' + os.ip
 
-        rows = self.execute(query, params)
+        # the catalog changes only a few times a day, so cache the rows,
+        # empty results included. random results must stay random.
+        cache = Caches.get('results') if os.sort_order != 'random' else None
+        rows = None
+        if cache is not None:
+            key = query + repr(sorted(params.items()))
+            rows = cache.get(key)
+        if rows is None:
+            rows = self.execute(query, params, os.ip)
+            if cache is not None:
+                cache.put(key, rows)
+
+        return rows
+
+
+    def format_rows(self, os, rows):
+        """ Format rows into `Cat´s.
+
+        rows may come from somewhere else than the database, they
+        need only support row.get ().
+
+        """
 
         # this is not necessarily the size of the result set.
         # if the result set is bigger than this page can show
@@ -925,9 +1270,27 @@ class SQLSearcher(object):
 
             os.entries.append(cat)
 
+        if len(rows) > os.items_per_page > 0:
+            os.next_page_cursor = self.make_cursor(os, rows[os.items_per_page - 1])
+
         return os
 
 
+    @staticmethod
+    def make_cursor(os, row):
+        """ Make a keyset pagination token pointing after row. """
+
+        if os.sort_order not in KEYSET_SORT_KEYS or os.query_digest is None:
+            return None
+        key = row.get(KEYSET_SORT_KEYS[os.sort_order][0])
+        pk = row.get('pk')
+        if key is None or pk is None:
+            # the next page will use OFFSET
+            return None
+        return encode_cursor(os.query_digest, os.sort_order,
+                             os.start_index + os.items_per_page, key, pk)
+
+
     @staticmethod
     def mogrify(dummy_os, sql):
         """ Format a query and return it as string without executing it. """
@@ -939,8 +1302,13 @@ class SQLSearcher(object):
 
 
     @staticmethod
-    def execute(query, params):
-        """ Execute a query and return an array of rows. """
+    def execute(query, params, comment=''):
+        """ Execute a query and return an array of rows.
+
+        The query gets prepared on the server, see:
+        ConnectionPool.execute ().
+
+        """
 
         conn = cherrypy.engine.pool.connect()
         try:
@@ -949,7 +1317,7 @@ class SQLSearcher(object):
             #cherrypy.log("SQL Query: %s\n" % c.mogrify (query, params),
             #              context = 'REQUEST', severity = logging.ERROR)
 
-            c.execute(query, params)
+            cherrypy.engine.pool.execute(conn, c, query, params, comment)
 
             return [xl(c, row) for row in c.fetchall()]
         except DatabaseError as what:
@@ -0,0 +1,450 @@
+'''
+run this with
+python Benchmark.py
+'''
+import gettext
+import os
+import random
+import time
+import timeit
+
+import cherrypy
+import genshi.core
+import genshi.template
+import psycopg2
+import regex
+
+import BaseFormatter
+import BaseSearcher
+import Formatters
+import i18n_tool
+import QueryCompiler
+import Vocabulary
+from Page import SearchPage
+
+QUERIES = [
+    'mark twain',
+    'a.twain t.huckleberry',
+    'dickens | ( collins ! woman )',
+    '#1342',
+    'l.fr type.audio cat´s cradle',
+    'Les Misérables (Victor Hugo)',
+]
+
+
+class OldQueryCompiler(object):
+    """ The regex chain SQLStatement used before QueryCompiler,
+    to compare against. """
+
+    prefix_to_prefix = QueryCompiler.PREFIX_TO_PREFIX
+
+    regex_cache = {}
+
+    @classmethod
+    def sub(cls, regex_, replace, query):
+        """ Like re.sub but also compile and cache the regex. """
+        if not isinstance(query, str):
+            query = query[0] if isinstance(query, list) and len(query) > 0 else ''
+
+        cregex = cls.regex_cache.setdefault(
+            regex_, regex.compile(regex_, regex.UNICODE | regex.VERSION1))
+        return cregex.sub(replace, query)
+
+    @classmethod
+    def preprocess_query(cls, query):
+        """ Preprocess query. """
+
+        sub = cls.sub
+
+        query = sub(r'[\p{Z}\p{P}\p{S}\p{M}\p{C}--.!|()#]', ' ', query)
+
+        query = sub(r'\b[!)]', ' ', query)
+        query = sub(r'[(]\b', ' ', query)
+
+        query = sub(r'\s*[|!()]\s*', r' \g<0> ', query)
+
+        query = sub(r'\s*\([.!|()#\s]+\)\s*', ' ', query)
+        return ' '.join(query.split())
+
+    @classmethod
+    def translate_query(cls, query):
+        """ Translate query from user syntax to postgres tsvec syntax. """
+
+        sub = cls.sub
+
+        def prefix_sub(match_object):
+            """ Translate from user-visible prefix to internal prefix. """
+            s = match_object.group(0)
+            return cls.prefix_to_prefix.get(s, s)
+
+        def balance(query):
+            """ Balance parens. """
+            def scan(query, up, down):
+                scan = ''
+                depth = 0
+                for char in query:
+                    if char == up:
+                        depth += 1
+                        scan += char
+                    elif char == down:
+                        depth += -1
+                        if depth < 0:
+                            depth = 0
+                        else:
+                            scan += char
+                    else:
+                        scan += char
+                return scan, depth
+            balanced, depth = scan(query, '(', ')')
+            if depth:
+                balanced, depth = scan(balanced[::-1], ')', '(')
+                balanced = balanced[::-1]
+            return balanced
+
+        query = sub(r'(\b\w+\.|#)(?=\w)', prefix_sub, query)
+
+        query = sub(r'\b(\p{L}+)(\s|$)', r'\1:*\2', query)
+        query = query.replace('. ', ' ')
+
+        query = balance(query)
+
+        query = sub(r'(^[ \|]+|[ \|\!]+$)', '', query)
+
+        query = ' '.join(query.split())
+        query = sub(r'(?<![|!(\s])\s+(?![|)])', ' & ', query)
+
+        return query
+
+
+def bench_query_compiler(number=2000):
+    """ Per-request cost of compiling the queries: a book search
+    preprocesses the query once and translates it four times.
+    The old regex chain runs on the same queries. """
+
+    def old():
+        for q in QUERIES:
+            echo = OldQueryCompiler.preprocess_query(q)
+            for dummy in range(4):
+                OldQueryCompiler.translate_query(echo)
+
+    def request():
+        for q in QUERIES:
+            echo = QueryCompiler.compile_query(q).echo
+            for dummy in range(4):
+                QueryCompiler.compile_query(echo).tsquery
+
+    def cold():
+        QueryCompiler.cache.clear()
+        request()
+
+    for name, func in (('old', old), ('cold', cold), ('cached', request)):
+        t = timeit.timeit(func, number=number)
+        print('query compiler %-8s %8.1f us/request' % (
+            name, t / number / len(QUERIES) * 1e6))
+
+
+def connect():
+    """ Connect to the database given in the PG* environment variables.
+    Returns None if there is no database. """
+    try:
+        return psycopg2.connect('')
+    except psycopg2.Error as what:
+        print('no database: %s' % str(what).strip())
+        return None
+
+
+def listing_sql(columns, sort_order='downloads', start_index=1):
+    """ Build the sql of an 'All Books' listing page. """
+    sql = BaseSearcher.SQLStatement()
+    sql.columns = columns
+    sql.from_ = ['v_appserver_books_4 as books']
+    sql.sort_order = sort_order
+    sql.start_index = start_index
+    sql.items_per_page = 25
+    return sql.build()
+
+
+def bench_projection(conn, number=50):
+    """ Bytes fetched and latency per result page, SELECT * vs.
+    the columns the formatters need. """
+
+    c = conn.cursor()
+    projected = ['books.' + column for column in SearchPage.columns]
+    for name, columns in (('select *', []), ('projection', projected)):
+        for sort_order in ('downloads', 'release_date', 'title'):
+            query, params = listing_sql(columns, sort_order)
+            c.execute('SELECT sum (pg_column_size (q.*)) FROM (%s) AS q' % query, params)
+            size = c.fetchone()[0]
+            start = time.perf_counter()
+            for dummy in range(number):
+                c.execute(query, params)
+                c.fetchall()
+            t = (time.perf_counter() - start) / number
+            print('%-10s %-12s %8d bytes/page %8.2f ms/page' % (
+                name, sort_order, size, t * 1e3))
+
+
+SUGGEST_PREFIXES = ['twai', 'dick', 'shak', 'holm', 'pride', 'mars', 'hist', 'fran']
+
+
+def bench_vocabulary_synthetic(number=10000):
+    """ Prefix lookups in a synthetic vocabulary of 500000 words. """
+
+    rnd = random.Random(42)
+    letters = 'etaoinshrdlcumwfgypbvk'
+    words = set()
+    while len(words) < 500000:
+        words.add(''.join(rnd.choice(letters) for dummy in range(rnd.randint(4, 12))))
+    words = sorted(words)
+    index = Vocabulary.Index(words, [rnd.randint(1, 10000) for dummy in words])
+    prefixes = [w[:4] for w in rnd.sample(words, 100)]
+
+    t = timeit.timeit(lambda: [index.complete(p, 6) for p in prefixes], number=number // 100)
+    print('suggest memory  %-8s %8.1f us/lookup' % ('synth', t / number * 1e6))
+
+
+def bench_suggestions(conn, number=20):
+    """ The suggestion query in SQL vs. the in-memory vocabulary. """
+
+    c = conn.cursor()
+    for prefix in SUGGEST_PREFIXES:
+        sql = BaseSearcher.SQLStatement()
+        sql.query = 'SELECT tsvec'
+        sql.from_ = ('books', )
+        sql.fulltext('books.tsvec', prefix)
+        inner = c.mogrify(*sql.build()).decode('utf-8')
+        query = ("SELECT substr (word, 2) AS title FROM ts_stat (%(inner)s) "
+                 "WHERE word ~* %(re_word)s ORDER BY nentry DESC LIMIT 6")
+        params = {'inner': inner, 're_word': '^0' + prefix}
+        start = time.perf_counter()
+        for dummy in range(number):
+            c.execute(query, params)
+            c.fetchall()
+        t = (time.perf_counter() - start) / number
+        print('suggest sql     %-8s %8.1f us/lookup' % (prefix, t * 1e6))
+
+    start = time.perf_counter()
+    Vocabulary.load(conn)
+    print('suggest load    %d words in %.1f s' % (
+        len(Vocabulary.index), time.perf_counter() - start))
+    for prefix in SUGGEST_PREFIXES:
+        t = timeit.timeit(lambda: Vocabulary.complete(prefix, 6), number=number * 100)
+        print('suggest memory  %-8s %8.1f us/lookup' % (prefix, t / number / 100 * 1e6))
+
+
+BENCH_SCHEMA = 'autocat_bench'
+
+ADVSEARCH_TERMS = [
+    # (term type, before, after), searched for every word of ADVSEARCH_WORDS
+    ('title',
+     "SELECT count(*) FROM attributes WHERE fk_attriblist IN (240, 245, 246) "
+     "AND text ILIKE %(like)s", None),
+    ('summary',
+     "SELECT count(*) FROM attributes WHERE fk_attriblist = 520 AND text ILIKE %(words)s",
+     "SELECT count(*) FROM attributes WHERE fk_attriblist = 520 "
+     "AND to_tsvector('simple'::regconfig, text) @@ phraseto_tsquery('simple'::regconfig, %(word)s)"),
+    ('author',
+     "SELECT count(*) FROM authors WHERE author ILIKE %(like)s OR pk IN "
+     "(SELECT authors.pk FROM authors JOIN aliases ON aliases.fk_authors = authors.pk "
+     "WHERE alias ILIKE %(like)s)",
+     "SELECT count(*) FROM authors WHERE pk IN (SELECT pk FROM authors WHERE author ILIKE %(like)s "
+     "UNION SELECT fk_authors FROM aliases WHERE alias ILIKE %(like)s)"),
+    ('subject',
+     "SELECT count(*) FROM subjects WHERE subject ILIKE %(like)s", None),
+]
+
+ADVSEARCH_WORDS = ['twain', 'whale', 'history', 'detective']
+
+
+def load_synthetic(conn, size=200000):
+    """ Fill BENCH_SCHEMA with random text in the shape of the catalog
+    tables the advanced search reads. """
+
+    from psycopg2.extras import execute_values
+
+    rnd = random.Random(42)
+    letters = 'etaoinshrdlcumwfgypbvk'
+    vocabulary = [''.join(rnd.choice(letters) for dummy in range(rnd.randint(3, 10)))
+                  for dummy in range(50000)] + ADVSEARCH_WORDS
+
+    def text(words):
+        return ' '.join(rnd.choice(vocabulary) for dummy in range(words))
+
+    c = conn.cursor()
+    c.execute('DROP SCHEMA IF EXISTS %s CASCADE' % BENCH_SCHEMA)
+    c.execute('CREATE SCHEMA %s' % BENCH_SCHEMA)
+    c.execute('SET search_path TO %s, public' % BENCH_SCHEMA)
+    c.execute('CREATE TABLE attributes (fk_books integer, fk_attriblist integer, text text)')
+    c.execute('CREATE TABLE authors (pk integer PRIMARY KEY, author text)')
+    c.execute('CREATE TABLE aliases (fk_authors integer, alias text)')
+    c.execute('CREATE TABLE subjects (pk integer PRIMARY KEY, subject text)')
+    execute_values(c, 'INSERT INTO attributes VALUES %s', [
+        (pk, rnd.choice((240, 245, 246)), text(6)) for pk in range(size)] + [
+        (pk, 520, text(80)) for pk in range(size // 4)])
+    execute_values(c, 'INSERT INTO authors VALUES %s', [
+        (pk, text(3)) for pk in range(size // 4)])
+    execute_values(c, 'INSERT INTO aliases VALUES %s', [
+        (rnd.randrange(size // 4), text(3)) for dummy in range(size // 10)])
+    execute_values(c, 'INSERT INTO subjects VALUES %s', [
+        (pk, text(4)) for pk in range(size // 4)])
+    conn.commit()
+
+
+def time_terms(c, rewritten, number):
+    """ Run the term queries of ADVSEARCH_TERMS, return seconds per query by term type. """
+
+    results = {}
+    for name, before, after in ADVSEARCH_TERMS:
+        query = (after or before) if rewritten else before
+        start = time.perf_counter()
+        for dummy in range(number):
+            for word in ADVSEARCH_WORDS:
+                c.execute(query, {'word': word, 'like': '%' + word + '%',
+                                  'words': '% ' + word + ' %'})
+                c.fetchall()
+        results[name] = (time.perf_counter() - start) / number / len(ADVSEARCH_WORDS)
+    return results
+
+
+def bench_advsearch_terms(conn, number=5):
+    """ Latency of the advanced search text terms on synthetic data,
+    before and after sql/advsearch_trgm.sql and the rewritten predicates. """
+
+    load_synthetic(conn)
+    conn.autocommit = True
+    c = conn.cursor()
+    # in public, else DROP SCHEMA CASCADE below drops the extension too
+    c.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm SCHEMA public')
+    c.execute('SET search_path TO %s, public' % BENCH_SCHEMA)
+    c.execute('ANALYZE')
+    before = time_terms(c, False, number)
+
+    # one by one, CREATE INDEX CONCURRENTLY cannot run in a transaction
+    with open('sql/advsearch_trgm.sql') as f:
+        for statement in f.read().split(';'):
+            if any(line.strip() and not line.startswith('--')
+                   for line in statement.splitlines()):
+                c.execute(statement)
+    after = time_terms(c, True, number)
+
+    for name, dummy, dummy in ADVSEARCH_TERMS:
+        print('advsearch %-8s %8.2f ms/term before %8.2f ms/term after' % (
+            name, before[name] * 1e3, after[name] * 1e3))
+    c.execute('DROP SCHEMA %s CASCADE' % BENCH_SCHEMA)
+    conn.autocommit = False
+
+
+class CountingCursor(psycopg2.extensions.cursor):
+    """ A cursor that counts the statements executed. """
+    statements = 0
+
+    def execute(self, query, vars=None):
+        CountingCursor.statements += 1
+        return super().execute(query, vars)
+
+
+def bench_dc_loader(conn, ids=(11, 84, 1342, 1513, 2701, 64317), number=5):
+    """ Round-trips and latency of load_from_database () vs. the
+    single-statement loader, one book and a gallery of books at once. """
+
+    class Pool:
+        def connect(self):
+            return conn
+
+    def per_book():
+        for id_ in ids:
+            BaseSearcher.DC(Pool()).load_from_database(id_)
+
+    def batch():
+        BaseSearcher.DC.load_many(Pool(), ids)
+
+    conn.cursor_factory = CountingCursor
+    for name, func in (('per book', per_book), ('load_many', batch)):
+        CountingCursor.statements = 0
+        start = time.perf_counter()
+        for dummy in range(number):
+            func()
+        t = (time.perf_counter() - start) / number
+        print('dc loader %-10s %4d statements %8.2f ms for %d books' % (
+            name, CountingCursor.statements // number, t * 1e3, len(ids)))
+    conn.cursor_factory = psycopg2.extensions.cursor
+
+
+def bench_template_translation(locales=('en', 'de', 'fr', 'pt', 'zh_CN'), number=200):
+    """ Per-render cost of translating results.html and bibrec.html at
+    render time, which the pretranslated variants do once when built.
+    The rest of the render is the same for both. """
+
+    install_dir = os.path.dirname(os.path.abspath(__file__))
+    mo_dir = os.path.join(install_dir, 'i18n')
+    loader = genshi.template.TemplateLoader(
+        os.path.join(install_dir, 'templates'), callback=Formatters.on_template_loaded)
+
+    for page in ('results.html', 'bibrec.html'):
+        template = loader.load(page)
+        translator = template.filters[0]
+        for locale in locales:
+            i18n = i18n_tool.load_translation([locale], mo_dir, 'messages', 'en')
+            cherrypy.response.i18n = i18n
+
+            def translate():
+                list(translator(iter(template.stream), genshi.template.Context()))
+
+            t = timeit.timeit(translate, number=number)
+            start = time.perf_counter()
+            BaseFormatter.pretranslated(template, i18n.trans)
+            build = time.perf_counter() - start
+            print('%-12s %-5s %-8s render-time translation %8.1f us/render, '
+                  'pretranslated 0, variant built in %6.1f ms' % (
+                      page, locale, 'catalog' if i18n.language else 'none',
+                      t / number * 1e6, build * 1e3))
+
+
+def bench_fragments(number=200):
+    """ Template events per render and the per-render cost of
+    serializing the static includes, which the variants splice in as
+    markup. """
+
+    import HTMLFormatter
+
+    install_dir = os.path.dirname(os.path.abspath(__file__))
+    loader = genshi.template.TemplateLoader(
+        os.path.join(install_dir, 'templates'), callback=Formatters.on_template_loaded)
+    formatter = HTMLFormatter.HTMLFormatter()
+    fragments = ('menu.html', 'footer.html')
+
+    def events(stream):
+        for event in stream:
+            yield event
+            if event[0] is BaseFormatter.SUB:
+                yield from events(event[1][1])
+
+    for page in ('results.html', 'bibrec.html'):
+        template = loader.load(page)
+        translations = gettext.NullTranslations()
+        plain = list(events(BaseFormatter.pretranslated(template, translations).stream))
+        spliced = list(events(BaseFormatter.pretranslated(
+            template, translations, formatter.get_fragment_serializer()).stream))
+        chrome = [e for e in plain if e[2] and os.path.basename(e[2][0]) in fragments]
+
+        def serialize():
+            ''.join(formatter.get_fragment_serializer()(genshi.core._ensure(
+                BaseFormatter.WHITESPACE_FILTER(iter(chrome),
+                                                collapse_lines=BaseFormatter.COLLAPSE_LINES))))
+
+        t = timeit.timeit(serialize, number=number)
+        print('%-12s %5d events, %5d with fragments, static includes %8.1f us/render' % (
+            page, len(plain), len(spliced), t / number * 1e6))
+
+
+if __name__ == '__main__':
+    bench_query_compiler()
+    bench_vocabulary_synthetic()
+    bench_template_translation()
+    bench_fragments()
+    conn = connect()
+    if conn is not None:
+        bench_projection(conn)
+        bench_suggestions(conn)
+        bench_advsearch_terms(conn)
+        bench_dc_loader(conn)
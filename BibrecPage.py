@@ -14,13 +14,17 @@ The bibrec page.
 
 from __future__ import unicode_literals
 
+import hmac
+
 import cherrypy
 
 from libgutenberg import GutenbergGlobals as gg
 from i18n_tool import ugettext as _
 from i18n_tool import ungettext as __
 
+import AuthorStats
 import BaseSearcher
+import Caches
 import Page
 
 SUMMARY_MARKERS = {
@@ -29,6 +33,47 @@ SUMMARY_MARKERS = {
     "Summary by Project Gutenberg staff",
     }
 
+purges = {}
+""" Book id => number of purges, invalidates the cached pages of the book. """
+
+
+def cache_key (os):
+    """ The cache key of a rendered bibrec page. """
+
+    params = sorted ((k, str (v)) for k, v in cherrypy.request.params.items ())
+    return (os.id, os.format, os.page_mode, os.lang, str (cherrypy.response.i18n.locale),
+            os.host, os.protocol, tuple (params))
+
+
+def file_stamp (id_):
+    """ Return (newest file mtime, number of files) of book id_. """
+
+    conn = cherrypy.engine.pool.connect ()
+    c = conn.cursor ()
+    c.execute ("""SELECT max (filemtime), count (*) FROM files
+                  WHERE fk_books = %(id)s AND obsoleted = 0 AND diskstatus = 0""",
+               { 'id': id_ })
+    return c.fetchone ()
+
+
+def page_stamp (id_):
+    """ The stamp of the cached pages of book id_.
+
+    Changes when the files of the book change or the book gets purged.
+
+    """
+
+    mtime, nfiles = file_stamp (id_)
+    return (mtime, nfiles, purges.get (id_, 0))
+
+
+def purge (id_):
+    """ Drop the cached pages of a book. """
+
+    purges[id_] = purges.get (id_, 0) + 1
+    BaseSearcher.dc_cache ().invalidate (id_)
+
+
 def is_a_summary(text):
     for summary_marker in SUMMARY_MARKERS:
         if summary_marker in text:
@@ -63,10 +108,45 @@ class BibrecPage (Page.Page):
 
         os.log_request ('bibrec')
 
-        dc = BaseSearcher.DC (cherrypy.engine.pool)
+        s = BaseSearcher.session ()
+        last_visited = s.get ('last_visited', [])
+        last_visited.append (os.id)
+        s['last_visited'] = last_visited
+
+        stamp = page_stamp (os.id)
+        mtime, nfiles = stamp[:2]
+        if nfiles:
+            # the breadcrumbs depend on the catalog
+            self.validate (os, (stamp, BaseSearcher.books_in_archive), mtime)
+
+        if any (os.user_dialog):
+            # a one-time message for this session, don't cache it
+            return self.render (os, stamp)
+        return self.cached_render (os, stamp)
+
+
+    def cached_render (self, os, stamp):
+        """ Return the page from the cache if it is still valid,
+        else render and cache it. """
+
+        cache = Caches.get ('bibrec')
+        key = cache_key (os)
+        cached = cache.get (key)
+        if cached is not None and cached[0] == stamp:
+            dummy_stamp, content_type, body = cached
+            cherrypy.response.headers['Content-Type'] = content_type
+            return body
+
+        body = self.render (os, stamp)
+        cache.put (key, (stamp, cherrypy.response.headers['Content-Type'], body))
+        return body
+
+
+    def render (self, os, stamp = None):
+        """ Load the book and render the page. """
 
         # the bulk of the work is done here
-        dc.load_from_database (os.id)
+        dc = BaseSearcher.get_dc (os.id, stamp)
         if not dc.files:
             # NOTE: Error message
             raise cherrypy.HTTPError (404, _('No ebook by that number.'))
@@ -110,23 +190,18 @@ class BibrecPage (Page.Page):
 
         os.entries.append (dc)
 
-        s = cherrypy.session
-        last_visited = s.get ('last_visited', [])
-        last_visited.append (os.id)
-        s['last_visited'] = last_visited
-
         # can we find some meaningful breadcrumbs ?
-        for a in dc.authors:
-            if a.marcrel in ('aut', 'cre'):
-                book_cnt = BaseSearcher.sql_get (
-                    "select count (*) from mn_books_authors where fk_authors = %(aid)s", aid = a.id)
-                if book_cnt > 1:
-                    os.breadcrumbs.append ((
-                        __('One by {author}', '{count} by {author}', book_cnt).format (
-                                count = book_cnt, author = dc.make_pretty_name (a.name)),
-                        _('Find more eBooks by the same author.'),
-                         os.url ('author', id = a.id)
-                        ))
+        authors = [a for a in dc.authors if a.marcrel in ('aut', 'cre')]
+        book_counts = AuthorStats.book_counts ([a.id for a in authors])
+        for a in authors:
+            book_cnt = book_counts[a.id]
+            if book_cnt > 1:
+                os.breadcrumbs.append ((
+                    __('One by {author}', '{count} by {author}', book_cnt).format (
+                            count = book_cnt, author = dc.make_pretty_name (a.name)),
+                    _('Find more eBooks by the same author.'),
+                     os.url ('author', id = a.id)
+                    ))
 
 
         if os.format == 'html':
@@ -162,3 +237,36 @@ class BibrecPage (Page.Page):
         os.finalize ()
 
         return self.format (os)
+
+
+class BibrecPurgePage (Page.Page):
+    """ Purge the cached pages of a book, eg. after editing its record.
+
+    Needs a POST with the secret token from the config in the
+    X-Purge-Token header:
+
+      bibrec.purge_token: 'some long random string'
+
+    Purging is off if there is no token. The client address is no
+    good for this: behind the proxy it comes from X-Forwarded-For.
+
+    """
+
+    def index (self, **kwargs):
+        """ Purge. """
+
+        if cherrypy.request.method != 'POST':
+            cherrypy.response.headers['Allow'] = 'POST'
+            raise cherrypy.HTTPError (405, 'Method Not Allowed')
+        token = cherrypy.config.get ('bibrec.purge_token')
+        given = cherrypy.request.headers.get ('X-Purge-Token', '')
+        if not token or not hmac.compare_digest (given.encode ('utf-8'), token.encode ('utf-8')):
+            raise cherrypy.HTTPError (403, 'Forbidden')
+        try:
+            id_ = int (kwargs.get ('id'))
+        except (ValueError, TypeError):
+            raise cherrypy.HTTPError (400, 'Bad Request. Bad id.')
+
+        purge (id_)
+        cherrypy.response.headers['Content-Type'] = 'text/plain; charset=UTF-8'
+        return b'purged\n'
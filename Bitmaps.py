@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+#  -*- mode: python; indent-tabs-mode: nil; -*- coding: utf-8 -*-
+
+"""
+Bitmaps.py
+
+Distributable under the GNU General Public License Version 3 or newer.
+
+Book pk bitmaps for the advanced search filters.
+
+For every language, LoC class, category and filetype we keep the set
+of books as a bitmap: a python int with bit n set if book n is in the
+set. With pks below 100000 a bitmap takes about 12 KB and intersecting
+two of them is a single C-level operation.
+
+Usage:
+  import Bitmaps
+  Bitmaps.load ()                        # in the timer thread
+  bits = Bitmaps.get ('lang', 'en')      # in the request thread
+  bits &= Bitmaps.get ('category', 1)
+  pks = Bitmaps.to_pks (bits)
+
+"""
+
+from __future__ import unicode_literals
+
+import logging
+
+import cherrypy
+from sqlalchemy import text
+
+from libgutenberg.Models import Book, Category, File, Lang, Locc
+
+import ConnectionPool
+
+FACETS = {
+    'filetype': lambda session: session.query(File.fk_filetypes, Book.pk).join(File),
+    'lang':     lambda session: session.query(Lang.id, Book.pk).join(Book.langs),
+    'locc':     lambda session: session.query(Locc.id, Book.pk).join(Book.loccs),
+    'category': lambda session: session.query(Category.pk, Book.pk).join(Book.categories),
+}
+""" Facet => function returning a query of (value, book pk) """
+
+bitmaps = {}
+""" Facet => { value => bitmap } """
+
+
+def from_pks(pks):
+    """ Make a bitmap from an iterable of pks. """
+
+    pks = list(pks)
+    if not pks:
+        return 0
+    buf = bytearray(max(pks) // 8 + 1)
+    for pk in pks:
+        buf[pk >> 3] |= 1 << (pk & 7)
+    return int.from_bytes(buf, 'little')
+
+
+def to_pks(bits):
+    """ Return the list of pks in a bitmap, ascending. """
+
+    pks = []
+    buf = bits.to_bytes((bits.bit_length() + 7) // 8, 'little')
+    for i, byte in enumerate(buf):
+        if byte:
+            base = i << 3
+            for bit in range(8):
+                if byte & (1 << bit):
+                    pks.append(base + bit)
+    return pks
+
+
+def count(bits):
+    """ Return the number of pks in a bitmap. """
+
+    return bin(bits).count('1')
+
+
+def load():
+    """ (Re)load all bitmaps from the database. Return True on success. """
+
+    global bitmaps
+
+    session = cherrypy.engine.pool.Session()
+    new_bitmaps = {}
+    try:
+        session.execute(text(ConnectionPool.NO_TIMEOUT))
+        for facet, query in FACETS.items():
+            lists = {}
+            for value, pk in query(session):
+                lists.setdefault(value, []).append(pk)
+            new_bitmaps[facet] = dict(
+                (value, from_pks(pks)) for value, pks in lists.items())
+    except Exception as what:
+        cherrypy.log("Cannot load bitmaps: %s" % what,
+                     context='ENGINE', severity=logging.WARNING)
+        return False
+    finally:
+        session.close()
+
+    bitmaps = new_bitmaps
+    return True
+
+
+def loaded():
+    """ Are the bitmaps loaded? """
+
+    return bool(bitmaps)
+
+
+def get(facet, value):
+    """ Return the bitmap of the books having value in facet.
+
+    Returns None if the bitmaps are not loaded yet.
+
+    """
+
+    values = bitmaps.get(facet)
+    if values is None:
+        return None
+    return values.get(value, 0)
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+#  -*- mode: python; indent-tabs-mode: nil; -*- coding: utf-8 -*-
+
+"""
+Caches.py
+
+Distributable under the GNU General Public License Version 3 or newer.
+
+A registry of named in-process caches.
+
+Each cache is a size-bounded LRU cache whose entries expire after a
+ttl. Size and ttl can be set in the config file like this:
+
+  cache.results.size: 2000
+  cache.results.ttl:  3600
+
+The size is a number of entries, or, for caches created with a weigh
+function, the approximate total size of the entries in bytes.
+
+All caches get cleared when the catalog changes.
+
+Usage:
+  import Caches
+  cache = Caches.get ('results')
+  rows = cache.get (key)
+  dcs = Caches.get ('dc', 64 * 1024 * 1024, weigh = Caches.approx_size)
+
+"""
+
+from __future__ import unicode_literals
+
+import collections
+import sys
+import threading
+import time
+
+import cherrypy
+from repoze.lru import ExpiringLRUCache
+
+DEFAULT_SIZE = 1000
+DEFAULT_TTL = 3600 # seconds
+
+caches = {}
+lock = threading.Lock ()
+
+
+class Cache (ExpiringLRUCache):
+    """ An ExpiringLRUCache whose counters survive clear (). """
+
+    def clear (self):
+        # ExpiringLRUCache.clear () resets the counters too and takes
+        # the lock, which is not reentrant. take the empty state from
+        # a new cache instead and swap it in under the lock.
+        empty = ExpiringLRUCache (self.size, self.default_timeout)
+        with self.lock:
+            self.data = empty.data
+            self.clock_keys = empty.clock_keys
+            self.clock_refs = empty.clock_refs
+            self.hand = empty.hand
+
+
+class SizedCache (object):
+    """ An LRU cache bounded by the total size of its entries in bytes,
+    as told by weigh (value).
+
+    Has the interface and the counters of Cache. Entries bigger than
+    the whole cache are not kept.
+
+    """
+
+    def __init__ (self, size, weigh, default_timeout = DEFAULT_TTL):
+        self.size = size
+        self.weigh = weigh
+        self.default_timeout = default_timeout
+        self.lock = threading.Lock ()
+        self.data = collections.OrderedDict ()
+        """ key => (value, expires, bytes) """
+        self.bytes = 0
+        self.hits = self.misses = self.lookups = self.evictions = 0
+
+    def _pop (self, key):
+        entry = self.data.pop (key, None)
+        if entry is not None:
+            self.bytes -= entry[2]
+
+    def get (self, key, default = None):
+        with self.lock:
+            self.lookups += 1
+            entry = self.data.get (key)
+            if entry is not None and entry[1] > time.time ():
+                self.hits += 1
+                self.data.move_to_end (key)
+                return entry[0]
+            self.misses += 1
+            return default
+
+    def put (self, key, value, timeout = None):
+        nbytes = self.weigh (value)
+        expires = time.time () + (timeout or self.default_timeout)
+        with self.lock:
+            self._pop (key)
+            if nbytes > self.size:
+                return
+            self.data[key] = (value, expires, nbytes)
+            self.bytes += nbytes
+            while self.bytes > self.size:
+                dummy_key, (dummy_value, dummy_expires, evicted) = self.data.popitem (last = False)
+                self.bytes -= evicted
+                self.evictions += 1
+
+    def invalidate (self, key):
+        with self.lock:
+            self._pop (key)
+
+    def clear (self):
+        with self.lock:
+            self.data.clear ()
+            self.bytes = 0
+
+
+def approx_size (obj, seen = None):
+    """ Return the approximate size of obj in bytes, with the
+    containers and the objects it refers to, except those whose
+    id () is in seen. """
+
+    if seen is None:
+        seen = set ()
+    if id (obj) in seen:
+        return 0
+    seen.add (id (obj))
+    size = sys.getsizeof (obj)
+    if isinstance (obj, dict):
+        size += sum (approx_size (k, seen) + approx_size (v, seen) for k, v in obj.items ())
+    elif isinstance (obj, (list, tuple, set, frozenset)):
+        size += sum (approx_size (item, seen) for item in obj)
+    elif hasattr (obj, '__dict__') and not isinstance (obj, type):
+        size += approx_size (vars (obj), seen)
+    return size
+
+
+def get (name, size = DEFAULT_SIZE, ttl = DEFAULT_TTL, weigh = None):
+    """ Return the cache called name. Create it on first use.
+
+    With weigh, a function returning the size of a value in bytes,
+    the cache is bounded by size in bytes, else by number of entries.
+
+    """
+
+    cache = caches.get (name)
+    if cache is None:
+        with lock:
+            cache = caches.get (name)
+            if cache is None:
+                size = cherrypy.config.get ('cache.%s.size' % name, size)
+                ttl = cherrypy.config.get ('cache.%s.ttl' % name, ttl)
+                if weigh is not None:
+                    cache = SizedCache (size, weigh, default_timeout = ttl)
+                else:
+                    cache = Cache (size, default_timeout = ttl)
+                caches[name] = cache
+    return cache
+
+
+def clear_all ():
+    """ Clear all caches, eg. because the catalog changed. """
+
+    for cache in list (caches.values ()):
+        cache.clear ()
+
+
+def metrics ():
+    """ Return a dict of prometheus-style cache metrics. """
+
+    metrics_ = {}
+    for name, cache in sorted (caches.items ()):
+        prefix = 'autocat3_cache_%s_' % name
+        metrics_[prefix + 'hits'] = cache.hits
+        metrics_[prefix + 'misses'] = cache.misses
+        metrics_[prefix + 'evictions'] = cache.evictions
+        metrics_[prefix + 'size'] = len (cache.data)
+        if isinstance (cache, SizedCache):
+            metrics_[prefix + 'bytes'] = cache.bytes
+    return metrics_
@@ -36,7 +36,7 @@ import StartPage
 import SuggestionsPage
 from SearchPage import BookSearchPage, AuthorSearchPage, SubjectSearchPage, BookshelfSearchPage, \
     AuthorPage, SubjectPage, BookshelfPage, AlsoDownloadedPage
-from BibrecPage import BibrecPage
+from BibrecPage import BibrecPage, BibrecPurgePage
 from AdvSearchPage import AdvSearchPage
 import CoverPages
 import QRCodePage
@@ -58,7 +58,9 @@ def error_page_404(status, message, traceback, version):
     resp = ErrorPage(status, message).index()
     
     # signal that we needn't save the session
-    cherrypy.session.loaded = False
+    session = getattr(cherrypy.serving, 'session', None)
+    if session is not None:
+        session.loaded = False
     return resp
 
 
@@ -249,6 +251,9 @@ def main():
     d.connect('download', r'/ebooks/{id:\d+}/download{.format}',
                controller=Page.NullPage(), _static=True)
 
+    d.connect('bibrec_purge', r'/ebooks/{id:\d+}/purge/',
+               controller=BibrecPurgePage(), conditions=dict(function=check_id))
+
     d.connect('bibrec', r'/ebooks/{id:\d+}{.format}',
                controller=BibrecPage(), conditions=dict(function=check_id))
 
@@ -283,10 +283,7 @@ class EbookMetaData (object):
 
     def get_dc (self):
         """ Get a DublinCore struct for the ebook. """
-        dc = BaseSearcher.DC (cherrypy.engine.pool)
-        dc.load_from_database (self.id)
-        # dc.translate ()
-        return dc
+        return BaseSearcher.get_dc (self.id)
 
 
     def get_extension (self):
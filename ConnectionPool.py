@@ -12,19 +12,63 @@ Distributable under the GNU General Public License Version 3 or newer.
 
 from __future__ import unicode_literals
 
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
 import logging
+import re
 
 import psycopg2
 
 import sqlalchemy.pool as pool
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
+from repoze.lru import LRUCache
 
 import cherrypy
 from cherrypy.process import plugins
 
 DUMMY_SQL_URL = "postgresql://127.0.0.1:5432/gutenberg"
 
+MAX_PREPARED = 100
+""" Max. number of prepared statements per connection. """
+
+NO_TIMEOUT = 'SET LOCAL statement_timeout = 0'
+""" Lifts the statement timeout for the rest of the transaction,
+for the loads that read whole tables in the timer thread. """
+
+RE_PARAM = re.compile(r'%\((\w+)\)s|%%')
+
+statement_cache = LRUCache(500)
+""" Prepared statement name, text and parameter names keyed by query text. """
+
+
+def to_prepared(query):
+    """ Convert a query with pyformat parameters into a statement for PREPARE.
+
+    Returns the statement name, the statement text with $n placeholders
+    and the list of parameter names in $n order.
+
+    """
+
+    prepared = statement_cache.get(query)
+    if prepared is None:
+        names = []
+
+        def placeholder(match):
+            name = match.group(1)
+            if name is None:
+                return '%'
+            if name not in names:
+                names.append(name)
+            return '$%d' % (names.index(name) + 1)
+
+        text = RE_PARAM.sub(placeholder, query)
+        name = 'autocat_' + hashlib.sha1(query.encode('utf-8')).hexdigest()[:16]
+        prepared = (name, text, names)
+        statement_cache.put(query, prepared)
+    return prepared
+
+
 class ConnectionCreator():
     """ Creates connections for the connection pool. """
 
@@ -36,7 +80,13 @@ class ConnectionCreator():
             "Connecting to database '%(database)s' on '%(host)s:%(port)d' as user '%(user)s'."
             % self.params, context='POSTGRES', severity=logging.INFO)
         conn = psycopg2.connect(**self.params)
-        conn.cursor().execute('SET statement_timeout = 5000')
+        c = conn.cursor()
+        c.execute('SET statement_timeout = 5000')
+        if conn.server_version >= 120000:
+            # see: ConnectionPool.execute()
+            c.execute('SET plan_cache_mode = force_custom_plan')
+        # else the rollback on return to the pool would undo the settings
+        conn.commit()
         return conn
 
 
@@ -49,6 +99,17 @@ class ConnectionPool(plugins.SimplePlugin):
         self.name = 'sqlalchemy'
         self.pool = None
         self.engine = None
+        self.executor = None
+        self.max_overflow = 0
+        self.reset_stats()
+
+
+    def reset_stats(self):
+        """ Reset the prepared statement counters. """
+
+        self.prepared_hits = 0
+        self.prepared_misses = 0
+        self.prepared_failures = 0
 
 
     def _start(self):
@@ -60,6 +121,8 @@ class ConnectionPool(plugins.SimplePlugin):
         recycle = cherrypy.config.get('sqlalchemy.recycle', 3600)
 
         self.bus.log("... pool_size = %d, max_overflow = %d" % (pool_size, max_overflow))
+        # negative means unlimited, we count only what we are sure of
+        self.max_overflow = max(max_overflow, 0)
         self.pool = pool.QueuePool(ConnectionCreator(self.params),
                                    pool_size=pool_size,
                                    max_overflow=max_overflow,
@@ -76,6 +139,65 @@ class ConnectionPool(plugins.SimplePlugin):
         return self.engine.raw_connection()
 
 
+    def spare_connections(self):
+        """ Return how many more connections could be checked out now
+        without waiting. """
+
+        if self.pool is None:
+            return 0
+        return self.pool.size() + self.max_overflow - self.pool.checkedout()
+
+
+    def execute(self, conn, cursor, query, params, comment=''):
+        """ Execute query as server-side prepared statement.
+
+        The statement gets PREPAREd on first use on a connection and
+        EXECUTEd afterwards, so postgres parses it only once.
+
+        The pooled connections run with plan_cache_mode =
+        force_custom_plan: postgres plans every EXECUTE for its actual
+        parameters. A generic plan, which postgres would switch to after
+        five executions, cannot know how selective a search term or how
+        big an offset is, and our parameters vary a lot in that.
+
+        The registry lives in the connection record's info dict, which
+        SQLAlchemy clears whenever the connection gets replaced.
+
+        If postgres refuses to prepare a statement, eg. because it
+        cannot infer a parameter type, the statement is executed the
+        normal way from then on.
+
+        """
+
+        name, text, names = to_prepared(query)
+        comment = ' -- ' + comment.replace('%', '%%') if comment else ''
+        prepared = conn.info.setdefault('prepared', {})
+        state = prepared.get(name)
+
+        if state is None and len(prepared) < MAX_PREPARED:
+            self.prepared_misses += 1
+            try:
+                cursor.execute('PREPARE %s AS %s' % (name, text))
+                state = prepared[name] = True
+            except psycopg2.DatabaseError as what:
+                self.prepared_failures += 1
+                cherrypy.log("Cannot prepare statement: %s" % what,
+                             context='POSTGRES', severity=logging.WARNING)
+                conn.rollback()
+                state = prepared[name] = False
+        elif state:
+            self.prepared_hits += 1
+
+        if not state:
+            cursor.execute(query + comment, params)
+        elif names:
+            cursor.execute('EXECUTE %s (%s)%s' % (
+                name, ', '.join(['%s'] * len(names)), comment),
+                [params[n] for n in names])
+        else:
+            cursor.execute('EXECUTE %s%s' % (name, comment))
+
+
     def start(self):
         """ Called on engine start. """
 
@@ -85,10 +207,20 @@ class ConnectionPool(plugins.SimplePlugin):
         else:
             self.bus.log("SQL connectors already exists.")
 
+        if self.executor is None:
+            # threads get started on first use, ie. after daemonizing
+            workers = cherrypy.config.get('sqlalchemy.parallel_workers', 4)
+            self.executor = ThreadPoolExecutor(max_workers=workers,
+                                               thread_name_prefix='sql')
+
 
     def stop(self):
         """ Called on engine stop. """
 
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+
         if self.engine is not None:
             self.bus.log("Disposing the SQL connection pool.")
             self.Session = None
@@ -101,8 +233,10 @@ class ConnectionPool(plugins.SimplePlugin):
 
         if self.engine is not None:
             self.bus.log("Restarting the SQL connection pool ...")
+            # disposing the connections also drops their prepared statements
             self.engine.dispose()
             self.engine, self.Session  = self._start()
+            self.reset_stats()
 
 
 cherrypy.process.plugins.ConnectionPool = ConnectionPool
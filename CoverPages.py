@@ -20,15 +20,17 @@ from sqlalchemy import select
 from sqlalchemy.sql import func
 
 from libgutenberg import GutenbergGlobals as gg
-from libgutenberg import DublinCore, DublinCoreMapping, Models
+from libgutenberg import DublinCore, Models
 
+import BaseSearcher
+import Sampler
 
 
 class CoverPages(object):
     """ Output a gallery of cover pages. """
 
     @staticmethod
-    def serve(books, size, session):
+    def serve(books, size):
         """ Output a gallery of coverpages. """
 
         def escape(_string):
@@ -43,15 +45,12 @@ class CoverPages(object):
         cherrypy.response.headers['Content-Type'] = 'text/html; charset=utf-8'
         cherrypy.response.headers['Content-Language'] = 'en'
         s = ''
-        for book_id in books:
-            dc = DublinCoreMapping.DublinCoreObject(session=session, pooled=True)
-            dc.load_from_database(book_id)
-            cover = session.execute(select(Models.File.archive_path).where(
-                Models.File.fk_books == book_id,
-                Models.File.fk_filetypes == size)).scalars().first()
-            if not cover:
+        for dc in BaseSearcher.get_dcs(books):
+            book_id = dc.project_gutenberg_id
+            covers = [file_.archive_path for file_ in dc.files if file_.filetype == size]
+            if not covers:
                 continue
-            url = '/' + cover
+            url = '/' + covers[0]
 
             href = '/ebooks/%d' % book_id
             if dc.title:
@@ -96,19 +95,22 @@ class CoverPages(object):
                 raise ValueError('bogus size')
             size = 'cover.%s' % size
 
+            rows = None
             if order == 'popular':
                 order_by = Models.Book.downloads.desc()
             elif order == 'random':
                 order_by = func.random()
+                rows = Sampler.sample(size, count)
             else:
                 order_by = Models.Book.release_date.desc()
-            rows = session.execute(select(Models.Book.pk).where(
-                Models.Book.pk == Models.File.fk_books,
-                Models.File.fk_filetypes == size
-            ).order_by(order_by).limit(count)).scalars().all()
+            if rows is None:
+                rows = session.execute(select(Models.Book.pk).where(
+                    Models.Book.pk == Models.File.fk_books,
+                    Models.File.fk_filetypes == size
+                ).order_by(order_by).limit(count)).scalars().all()
 
             if rows:
-                return self.serve(rows, size, session)
+                return self.serve(rows, size)
 
         except (ValueError, KeyError) as what:
             raise cherrypy.HTTPError (400, 'Bad Request. %s' % six.text_type(what))
@@ -35,6 +35,10 @@ def format (format_, page, os_):
 
 
 formatters = {}
+
+version = 0.0
+""" Newest mtime of the templates, part of the page validators. """
+
 formatters['opds']     = OPDSFormatter.OPDSFormatter   ()
 formatters['stanza']   = formatters['opds']
 formatters['html']     = HTMLFormatter.HTMLFormatter   ()
@@ -57,6 +61,8 @@ def on_template_loaded (template):
 def init ():
     """ Load all template files in template_dir. """
 
+    global version
+
     template_dir = cherrypy.config['genshi.template_dir']
 
     for fn in glob.glob (os.path.join (template_dir, '*')):
@@ -65,6 +71,7 @@ def init ():
             continue
 
         cherrypy.engine.autoreload.files.update (fn)
+        version = max (version, os.path.getmtime (fn))
 
         bn = os.path.basename (fn)
         template = genshi.template.TemplateLoader (
@@ -0,0 +1,390 @@
+#!/usr/bin/env python
+#  -*- mode: python; indent-tabs-mode: nil; -*- coding: utf-8 -*-
+
+"""
+InvertedIndex.py
+
+Distributable under the GNU General Public License Version 3 or newer.
+
+An in-process alternative to `books.tsvec @@ to_tsquery ()`.
+
+Holds an inverted index over the lexemes of the books' tsvectors:
+for every lexeme a posting list of book pks, delta-encoded as
+varints. Because it indexes the lexemes postgres made, all prefixes
+(ax, tx, l0, lcc0, ...  see: QueryCompiler.PREFIX_TO_PREFIX) work
+the same as in the database.
+
+Queries are normalized by postgres, ie. stemmed and stop-worded by
+to_tsquery (), and the result is cached. The normalized query gets
+evaluated here. Queries with phrase operators or weights are declined
+and go to the database.
+
+Select the backend in the config:
+
+  search.backend: 'index'     # default: 'sql'
+
+"""
+
+from __future__ import unicode_literals
+
+import bisect
+import collections
+import heapq
+import logging
+import threading
+
+import cherrypy
+import regex
+
+from libgutenberg.GutenbergDatabase import xl
+
+import Caches
+import ConnectionPool
+
+DECODED_BUDGET = 250000
+""" Max. number of pks in all cached decoded posting sets together. """
+
+SORT_KEYS = ('downloads', 'release_date')
+""" Sort orders the index can produce. Like SQL: key DESC, pk DESC. """
+
+RE_TSQUERY_TOKEN = regex.compile (r"""
+    '(?P<lexeme> (?: [^'\\] | '' | \\. )* )' (?P<flags> :[*A-D]+ )?
+  | (?P<op> [&|!()] )
+  | (?P<phrase> <\d*-?> )
+  | (?P<other> \S )
+""", regex.VERBOSE)
+
+
+class Decline (Exception):
+    """ The index cannot answer this query. Ask the database. """
+    pass
+
+
+def encode (pks):
+    """ Delta-encode an ascending list of ints as varints. """
+
+    out = bytearray ()
+    prev = 0
+    for pk in pks:
+        delta = pk - prev
+        prev = pk
+        while delta >= 0x80:
+            out.append ((delta & 0x7f) | 0x80)
+            delta >>= 7
+        out.append (delta)
+    return bytes (out)
+
+
+def decode (data):
+    """ Decode the output of encode (). """
+
+    pks = []
+    pk = 0
+    delta = 0
+    shift = 0
+    for byte in bytearray (data):
+        delta |= (byte & 0x7f) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            pk += delta
+            pks.append (pk)
+            delta = 0
+            shift = 0
+    return pks
+
+
+def parse_tsquery (text):
+    """ Parse the text representation of a tsquery.
+
+    Returns nested tuples: ('lexeme', lexeme, prefix), ('!', node),
+    ('&', left, right), ('|', left, right) or None for an empty query.
+
+    """
+
+    tokens = []
+    for m in RE_TSQUERY_TOKEN.finditer (text):
+        if m.group ('lexeme') is not None:
+            flags = m.group ('flags') or ''
+            if flags.strip (':*'):
+                raise Decline ('weights')
+            lexeme = regex.sub (r"''|\\(.)", lambda m: m.group (1) or "'", m.group ('lexeme'))
+            tokens.append (('lexeme', lexeme, '*' in flags))
+        elif m.group ('op'):
+            tokens.append (m.group ('op'))
+        elif m.group ('phrase'):
+            raise Decline ('phrase')
+        else:
+            raise Decline ('syntax')
+
+    if not tokens:
+        return None
+
+    pos = [0]
+
+    def peek ():
+        return tokens[pos[0]] if pos[0] < len (tokens) else None
+
+    def take ():
+        pos[0] += 1
+        return tokens[pos[0] - 1]
+
+    def or_expr ():
+        node = and_expr ()
+        while peek () == '|':
+            take ()
+            node = ('|', node, and_expr ())
+        return node
+
+    def and_expr ():
+        node = not_expr ()
+        while peek () == '&':
+            take ()
+            node = ('&', node, not_expr ())
+        return node
+
+    def not_expr ():
+        token = take () if peek () is not None else None
+        if token == '!':
+            return ('!', not_expr ())
+        if token == '(':
+            node = or_expr ()
+            if take () != ')':
+                raise Decline ('syntax')
+            return node
+        if isinstance (token, tuple):
+            return token
+        raise Decline ('syntax')
+
+    node = or_expr ()
+    if pos[0] != len (tokens):
+        raise Decline ('syntax')
+    return node
+
+
+class DecodedCache (object):
+    """ An LRU cache of decoded posting sets, bounded by the total
+    number of pks in them.
+
+    A set of n pks takes about 70 * n bytes. Sets bigger than an
+    eighth of the budget, eg. of language terms or short prefixes,
+    are not cached but decoded on every use.
+
+    """
+
+    def __init__ (self, budget):
+        self.budget = budget
+        self.size = 0
+        self.data = collections.OrderedDict ()
+        self.lock = threading.Lock ()
+
+
+    def get (self, key):
+        """ Return the cached set or None. """
+
+        with self.lock:
+            pks = self.data.get (key)
+            if pks is not None:
+                self.data.move_to_end (key)
+            return pks
+
+
+    def put (self, key, pks):
+        """ Cache a set, evicting the least recently used ones. """
+
+        if len (pks) > self.budget // 8:
+            return
+        with self.lock:
+            old = self.data.pop (key, None)
+            if old is not None:
+                self.size -= len (old)
+            self.data[key] = pks
+            self.size += len (pks)
+            while self.size > self.budget:
+                dummy_key, evicted = self.data.popitem (last = False)
+                self.size -= len (evicted)
+
+
+class Index (object):
+    """ An inverted index of lexemes to book pks. """
+
+    def __init__ (self):
+        self.postings = {}
+        """ lexeme => encoded ascending pks """
+        self.lexemes = []
+        """ sorted lexemes for prefix lookups """
+        self.universe = frozenset ()
+        """ all pks with a tsvector, for the '!' operator """
+        self.ranks = {}
+        """ sort key => { pk => position in that sort order } """
+        self.decoded = DecodedCache (DECODED_BUDGET)
+        """ recently used posting lists as sets """
+
+
+    @classmethod
+    def build (cls, docs):
+        """ Build index from an iterable of (pk, downloads, release_date, lexemes). """
+
+        index = cls ()
+        lists = {}
+        universe = set ()
+        keys = dict ((key, {}) for key in SORT_KEYS)
+        for pk, downloads, release_date, lexemes in docs:
+            keys['downloads'][pk] = downloads
+            keys['release_date'][pk] = release_date
+            if lexemes is None:
+                # NULL @@ tsquery is never true
+                continue
+            universe.add (pk)
+            for lexeme in lexemes:
+                lists.setdefault (lexeme, []).append (pk)
+
+        for lexeme, pks in lists.items ():
+            index.postings[lexeme] = encode (sorted (set (pks)))
+        index.lexemes = sorted (index.postings)
+        index.universe = frozenset (universe)
+
+        for key, values in keys.items ():
+            # ORDER BY key DESC, pk DESC puts NULLs first
+            order = sorted (values, reverse = True, key = lambda pk: (
+                values[pk] is None, values[pk] or 0, pk))
+            index.ranks[key] = dict ((pk, rank) for rank, pk in enumerate (order))
+        return index
+
+
+    def lookup (self, lexeme, prefix):
+        """ Return the set of pks containing lexeme, or any lexeme
+        starting with lexeme if prefix is True. """
+
+        key = (lexeme, prefix)
+        pks = self.decoded.get (key)
+        if pks is None:
+            if prefix:
+                pks = set ()
+                lexemes = self.lexemes
+                i = bisect.bisect_left (lexemes, lexeme)
+                while i < len (lexemes) and lexemes[i].startswith (lexeme):
+                    pks.update (decode (self.postings[lexemes[i]]))
+                    i += 1
+            else:
+                pks = set (decode (self.postings.get (lexeme, b'')))
+            self.decoded.put (key, pks)
+        return pks
+
+
+    def evaluate (self, node):
+        """ Return the set of pks matching the parsed tsquery node. """
+
+        op = node[0]
+        if op == 'lexeme':
+            return self.lookup (node[1], node[2])
+        if op == '!':
+            return self.universe - self.evaluate (node[1])
+        if op == '&':
+            left, right = node[1], node[2]
+            if right[0] == '!':
+                return self.evaluate (left) - self.evaluate (right[1])
+            if left[0] == '!':
+                return self.evaluate (right) - self.evaluate (left[1])
+            return self.evaluate (left) & self.evaluate (right)
+        return self.evaluate (node[1]) | self.evaluate (node[2])
+
+
+    def search (self, tsquery, sort_key, offset, limit):
+        """ Return the pks matching the normalized tsquery text, ordered
+        by sort_key, from offset, at most limit. """
+
+        node = parse_tsquery (tsquery)
+        if node is None:
+            return []
+        pks = self.evaluate (node)
+        rank = self.ranks[sort_key]
+        return heapq.nsmallest (offset + limit, pks, key = rank.__getitem__)[offset:]
+
+
+index = None
+""" The current Index or None if not loaded. """
+
+
+def enabled ():
+    """ Is the index selected as search backend? """
+    return cherrypy.config.get ('search.backend', 'sql') == 'index'
+
+
+def load (conn = None, where = ''):
+    """ (Re)build the index from the database. Return True on success. """
+
+    global index
+
+    if conn is None:
+        conn = cherrypy.engine.pool.connect ()
+    # stream, don't fetchall ()
+    c = conn.cursor ('inverted_index')
+    c.itersize = 2000
+    try:
+        conn.cursor ().execute (ConnectionPool.NO_TIMEOUT)
+        c.execute ("""SELECT pk, downloads, release_date, tsvector_to_array (tsvec)
+                      FROM v_appserver_books_4 %s""" % where)
+        new_index = Index.build (c)
+        c.close ()
+    except Exception as what:
+        cherrypy.log ("Cannot build inverted index: %s" % what,
+                      context = 'ENGINE', severity = logging.WARNING)
+        conn.rollback ()
+        return False
+
+    index = new_index
+    return True
+
+
+def normalize (stemmer, tsquery):
+    """ Let postgres stem the query, so it matches the indexed lexemes. """
+
+    cache = Caches.get ('tsquery')
+    key = (stemmer, tsquery)
+    text = cache.get (key)
+    if text is None:
+        conn = cherrypy.engine.pool.connect ()
+        c = conn.cursor ()
+        c.execute ("SELECT to_tsquery (%(stemmer)s::regconfig, %(q)s)::text",
+                   { 'stemmer': stemmer, 'q': tsquery })
+        text = c.fetchone ()[0]
+        cache.put (key, text)
+    return text
+
+
+def search (sql):
+    """ Try to answer an SQLStatement from the index.
+
+    Returns the matching rows as SQLSearcher.execute () would, or None
+    if the index cannot answer this statement.
+
+    """
+
+    idx = index
+    if idx is None or not enabled ():
+        return None
+    if (len (sql.fulltexts) != 1 or len (sql.where) != 1 or sql.groupby or sql.query
+            or sql.from_ != ['v_appserver_books_4 as books']
+            or sql.sort_order not in SORT_KEYS):
+        return None
+    field, stemmer, tsquery = sql.fulltexts[0]
+    if field != 'books.tsvec':
+        return None
+
+    try:
+        pks = idx.search (normalize (stemmer, tsquery), sql.sort_order,
+                          max (sql.start_index - 1, 0), sql.items_per_page + 1)
+    except Decline:
+        return None
+
+    if not pks:
+        return []
+
+    # the page rows come from the database, by primary key
+    conn = cherrypy.engine.pool.connect ()
+    c = conn.cursor ()
+    c.execute ("SELECT %s FROM v_appserver_books_4 AS books WHERE books.pk = ANY (%%(pks)s)"
+               % (", ".join (sql.columns) or "*"), { 'pks': pks })
+    rows = dict ((row.pk, row) for row in (xl (c, row) for row in c.fetchall ()))
+    return [rows[pk] for pk in pks if pk in rows]
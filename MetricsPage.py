@@ -14,6 +14,7 @@ import threading
 import cherrypy
 from cherrypy.lib.sessions import RamSession
 from Page import Page
+import Caches
 
 class MetricsPage (Page):
     """ prometheus-exporter style metrics """
@@ -61,11 +62,14 @@ class MetricsPage (Page):
                 "autocat3_sqlalchemy_pool_available": db_pool.checkedin(),
                 "autocat3_sqlalchemy_pool_used": db_pool.checkedout(),
                 "autocat3_sqlalchemy_pool_overflow": db_pool.overflow(),
+                "autocat3_prepared_statements_hits": cherrypy.engine.pool.prepared_hits,
+                "autocat3_prepared_statements_misses": cherrypy.engine.pool.prepared_misses,
+                "autocat3_prepared_statements_failures": cherrypy.engine.pool.prepared_failures,
             }
         else:
             db_metrics = {}
 
-        metrics = core_metrics | http_server_metrics | db_metrics
+        metrics = core_metrics | http_server_metrics | db_metrics | Caches.metrics()
 
         cherrypy.response.headers['Content-Type'] = 'text/plain'
 
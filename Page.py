@@ -13,9 +13,12 @@ Base class for all pages.
 """
 from __future__ import unicode_literals
 
+import calendar
+import hashlib
 import logging
 
 import cherrypy
+from cherrypy.lib import cptools, httputil
 
 from libgutenberg.DublinCore import DublinCore
 from libgutenberg.MediaTypes import mediatypes as mt
@@ -38,6 +41,32 @@ class Page(object):
         return Formatters.formatters[os.format].format(os.template, os)
 
 
+    @staticmethod
+    def validate(os, parts, last_modified=None):
+        """ Send the validators of the page about to be rendered.
+
+        Raises 304 Not Modified if the client has the page already.
+
+        parts: what the page depends on besides the request and the templates
+        last_modified: a naive UTC datetime or None
+        """
+        context = (os.format, os.page_mode, os.lang, str(cherrypy.response.i18n.locale),
+                   os.host, os.protocol, os.user_dialog, os.search_terms, os.sort_order,
+                   sorted((k, str(v)) for k, v in cherrypy.request.params.items()),
+                   Formatters.version)
+        headers = cherrypy.response.headers
+        headers['ETag'] = '"%s"' % hashlib.sha1(
+            repr((context, parts)).encode('utf-8')).hexdigest()
+        if last_modified is not None:
+            headers['Last-Modified'] = httputil.HTTPDate(
+                max(calendar.timegm(last_modified.timetuple()), Formatters.version))
+
+        cptools.validate_etags()
+        # If-None-Match takes precedence
+        if 'If-None-Match' not in cherrypy.request.headers:
+            cptools.validate_since()
+
+
     def client_book_mediatypes(self):
         """ Return the book mediatypes accepted by the client. """
         client_accepted_book_mediatypes = []
@@ -76,6 +105,11 @@ class GoHomePage(Page):
 class SearchPage(Page):
     """ Abstract base class for all search page classes. """
 
+    columns = ('pk', 'title', 'filing', 'author', 'fk_langs', 'fk_categories',
+               'coverpages', 'downloads', 'release_date')
+    """ The columns of v_appserver_books_4 the formatters and sort
+    orders need. Ignored by pages that set their own sql.query. """
+
     def setup(self, dummy_os, dummy_sql):
         """ Let derived classes setup the query. """
         raise NotImplementedError
@@ -106,8 +140,12 @@ class SearchPage(Page):
         if os.start_index > BaseSearcher.MAX_RESULTS:
             raise cherrypy.HTTPError(400, 'Bad Request. Parameter start_index too high')
 
+        # independent queries that derived classes may start in setup ()
+        # and collect in fixup ()
+        os.queries = BaseSearcher.ParallelQueries()
+
         sql = BaseSearcher.SQLStatement()
-        sql.query = 'SELECT *'
+        sql.columns = ['books.' + column for column in self.columns]
         sql.from_ = ['v_appserver_books_4 as books']
 
         # let derived classes prepare the query
@@ -141,6 +179,11 @@ class SearchPage(Page):
         # give derived class a chance to tweak result set
         self.fixup(os)
 
+        # the entries and the catalog, the rest depends on the request
+        self.validate(os, (
+            BaseSearcher.books_in_archive, os.total_results, os.next_page_cursor,
+            [(e.url, e.title, e.subtitle, e.extra) for e in os.entries]))
+
         # warn user about no records found
         if os.total_results == 0:
             self.nothing_found(os)
@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+#  -*- mode: python; indent-tabs-mode: nil; -*- coding: utf-8 -*-
+
+"""
+Prerender.py
+
+Distributable under the GNU General Public License Version 3 or newer.
+
+Render the bibrec pages and the sitemaps to disk, for the front proxy
+to serve without asking the app server.
+
+The pages are rendered by the app itself: every page is a GET through
+the app's WSGI interface with the default locale, so the files are
+what a client without session and Accept-Language would get.
+
+  /ebooks/{id}             => {outdir}/ebooks/{id}.html
+  /ebooks/{id}.opds        => {outdir}/ebooks/{id}.opds
+  /ebooks/sitemaps/        => {outdir}/ebooks/sitemaps/index.xml
+  /ebooks/sitemaps/{n}     => {outdir}/ebooks/sitemaps/{n}.xml
+
+A manifest in {outdir} remembers the newest file mtime and the number
+of files of every rendered book, the same stamp the bibrec page uses
+for its validators. A run renders only the books whose stamp changed,
+and removes the pages of books that have no files anymore. Changed
+templates cause a full run, as does --all. Catalog edits that do not
+touch the files, and the download counts, are not seen: do an --all
+run now and then.
+
+Files are written to a temp file and renamed, so the proxy never
+sees a half-written page.
+
+Usage:
+  python Prerender.py /var/lib/autocat/prerendered [--jobs 8] [--all]
+
+"""
+
+from __future__ import unicode_literals
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import tempfile
+import wsgiref.util
+
+import cherrypy
+
+import AuthorStats
+import BaseSearcher
+import Formatters
+import Sitemap
+
+MANIFEST = '.prerender.json'
+
+STAMP_SQL = """
+SELECT fk_books, max (filemtime), count (*) FROM files
+WHERE obsoleted = 0 AND diskstatus = 0
+GROUP BY fk_books
+"""
+
+app = None
+""" The cherrypy application, set up in main () and inherited by the workers. """
+
+outdir = None
+""" The output directory. """
+
+
+def book_pages (id_):
+    """ The prerendered pages of a book as (url path, file name). """
+
+    return (('/ebooks/%d' % id_,      'ebooks/%d.html' % id_),
+            ('/ebooks/%d.opds' % id_, 'ebooks/%d.opds' % id_))
+
+
+def sitemap_pages (lastbook):
+    """ The sitemap pages as (url path, file name). """
+
+    pages = [('/ebooks/sitemaps/', 'ebooks/sitemaps/index.xml')]
+    for n in range (0, lastbook // Sitemap.SITEMAP_SIZE + 1):
+        pages.append (('/ebooks/sitemaps/%d' % n, 'ebooks/sitemaps/%d.xml' % n))
+    return pages
+
+
+def changes (manifest, stamps, version, everything = False):
+    """ Compare the manifest of the last run with the current stamps.
+
+    Returns the ids of the books to render and the ids of the books
+    whose pages must go.
+
+    """
+
+    books = manifest.get ('books', {})
+    done = {} if everything or manifest.get ('version') != version else books
+    todo = sorted (id_ for id_, stamp in stamps.items () if done.get (id_) != stamp)
+    gone = sorted (id_ for id_ in books if id_ not in stamps)
+    return todo, gone
+
+
+def write_atomic (filename, data):
+    """ Write data to filename, atomically replacing an old file. """
+
+    dirname = os.path.dirname (filename)
+    os.makedirs (dirname, exist_ok = True)
+    fd, tmp = tempfile.mkstemp (dir = dirname, prefix = '.tmp-')
+    try:
+        with os.fdopen (fd, 'wb') as fp:
+            fp.write (data)
+        # mkstemp makes it private, the proxy must read it
+        os.chmod (tmp, 0o644)
+        os.replace (tmp, filename)
+    except:
+        os.unlink (tmp)
+        raise
+
+
+def remove (filename):
+    """ Remove a file if it is there. """
+
+    try:
+        os.unlink (filename)
+    except FileNotFoundError:
+        pass
+
+
+def fetch (path):
+    """ GET path from the app. Return (status code, body). """
+
+    host = cherrypy.config['host']
+    environ = {
+        'PATH_INFO': path,
+        'HTTP_HOST': host,
+        'HTTP_X_FORWARDED_HOST': host,
+        'REMOTE_ADDR': '127.0.0.1',
+        'wsgi.url_scheme': 'https',
+    }
+    wsgiref.util.setup_testing_defaults (environ)
+
+    status = []
+
+    def start_response (status_, dummy_headers, dummy_exc_info = None):
+        status.append (status_)
+
+    result = app (environ, start_response)
+    try:
+        body = b''.join (result)
+    finally:
+        # lets cherrypy clean up the request
+        if hasattr (result, 'close'):
+            result.close ()
+    return int (status[0].split ()[0]), body
+
+
+def init_worker ():
+    """ Give the worker process its own connections. """
+
+    cherrypy.engine.pool.start ()
+    AuthorStats.load ()
+
+
+def render (job):
+    """ Render the pages of a job: (book id or None, pages).
+
+    Returns (book id, success). The pages of a book that is not
+    found are removed.
+
+    """
+
+    id_, pages = job
+    for path, filename in pages:
+        filename = os.path.join (outdir, filename)
+        try:
+            status, body = fetch (path)
+        except Exception as what:
+            status, body = 500, str (what)
+        if status == 200:
+            write_atomic (filename, body)
+        elif status == 404:
+            remove (filename)
+        else:
+            cherrypy.log ("Cannot render %s: %d %s" % (path, status, body[:200]),
+                          context = 'PRERENDER', severity = logging.ERROR)
+            return id_, False
+    return id_, True
+
+
+def main ():
+    """ Render the changed pages using the app server config. """
+
+    global app, outdir
+
+    parser = argparse.ArgumentParser (description = 'Render bibrec pages and sitemaps to disk.')
+    parser.add_argument ('outdir', help = 'the directory the front proxy serves')
+    parser.add_argument ('--jobs', type = int, default = multiprocessing.cpu_count (),
+                         help = 'number of worker processes')
+    parser.add_argument ('--all', action = 'store_true',
+                         help = 'render all books, not only the changed ones')
+    args = parser.parse_args ()
+
+    import CherryPyApp
+
+    # config, templates and routes, but no server
+    app = CherryPyApp.main ()
+    # every page would start a session that nobody ever comes back to
+    app.merge ({ '/': { 'tools.sessions.on': False } })
+    outdir = args.outdir
+
+    manifest_filename = os.path.join (outdir, MANIFEST)
+    manifest = {}
+    try:
+        with open (manifest_filename) as fp:
+            manifest = json.load (fp)
+    except (IOError, ValueError):
+        pass
+    manifest['books'] = dict ((int (id_), stamp) for id_, stamp
+                              in manifest.get ('books', {}).items ())
+
+    # the workers must not share our connections, stop the pool before forking
+    cherrypy.engine.pool.start ()
+    conn = cherrypy.engine.pool.connect ()
+    c = conn.cursor ()
+    c.execute (STAMP_SQL)
+    stamps = dict ((id_, [mtime.isoformat () if mtime else None, count])
+                   for id_, mtime, count in c.fetchall ())
+    conn.close ()
+    BaseSearcher.books_in_archive = BaseSearcher.sql_get ('select count (*) from books')
+    # 99999 is safeguard against bogus ebook numbers
+    lastbook = BaseSearcher.sql_get ('select max (pk) from books where pk < 99999')
+    cherrypy.engine.pool.stop ()
+
+    todo, gone = changes (manifest, stamps, Formatters.version, args.all)
+    cherrypy.log ("Rendering %d books, removing %d." % (len (todo), len (gone)),
+                  context = 'PRERENDER', severity = logging.INFO)
+
+    # after a full run only the books rendered now are up to date
+    full = args.all or manifest.get ('version') != Formatters.version
+    books = {} if full else manifest['books']
+    for id_ in gone:
+        for dummy_path, filename in book_pages (id_):
+            remove (os.path.join (outdir, filename))
+        books.pop (id_, None)
+
+    jobs = [(id_, book_pages (id_)) for id_ in todo]
+    jobs.append ((None, sitemap_pages (lastbook or 0)))
+
+    failed = 0
+    pool = multiprocessing.get_context ('fork').Pool (args.jobs, init_worker)
+    try:
+        for id_, ok in pool.imap_unordered (render, jobs, chunksize = 20):
+            if not ok:
+                failed += 1
+            elif id_ is not None:
+                books[id_] = stamps[id_]
+    finally:
+        pool.close ()
+        pool.join ()
+
+    write_atomic (manifest_filename, json.dumps (
+        { 'version': Formatters.version, 'books': books }).encode ('utf-8'))
+
+    cherrypy.log ("Rendered %d jobs, %d failed." % (len (jobs) - failed, failed),
+                  context = 'PRERENDER', severity = logging.INFO)
+
+
+if __name__ == '__main__':
+    main ()
@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+#  -*- mode: python; indent-tabs-mode: nil; -*- coding: utf-8 -*-
+
+"""
+QueryCompiler.py
+
+Distributable under the GNU General Public License Version 3 or newer.
+
+Compiles a user query into the string we echo back to the user and
+the string we feed to postgres' to_tsquery ().
+
+The user syntax is: words separated by whitespace (implicit AND),
+'|' (OR), '!' (NOT) and '( )' for grouping. Grouping parens and the
+NOT operator must be separated from the words by whitespace.
+
+The query is tokenized in one pass, parsed into a small tree and the
+tree is emitted twice. Malformed input is repaired, not rejected:
+dangling operators and unbalanced parens get dropped.
+
+"""
+
+from __future__ import unicode_literals
+
+import regex
+from repoze.lru import LRUCache
+
+
+PREFIX_TO_PREFIX = {
+    'a.': 'ax',
+    't.': 'tx',
+    's.': 'sx',
+    'bs.': 'bsx',
+    'l.': 'l0',
+    '#': 'no.',
+    'n.': 'no.',
+    'type.': 'y0',
+    'lcn.': 'lcnx',
+    'lcc.': 'lcc0',
+    'cat.': 'cat0',
+}
+"""Dict of user-visible prefixes to translate.
+
+User-visible prefixes must be easy to type. The dot is on the
+lowercase keyboard of most phones, so you need no shifting to type
+these.
+
+Internal prefixes exploit the quirks of the tsvec stemmer. Words
+containing numbers do not get stemmed, so any '*0' prefix searches
+for the unstemmed word. All other words get stemmed, so any '*x'
+prefix searches for the stem of the word. 'x' was selected because
+it is a rare character that will cause few false positives.
+
+"""
+
+RE_TOKEN = regex.compile (r"""
+    (?<=[\p{L}\p{N}]) [!)]        # operator glued to the end of a word
+  | [(] (?=[\p{L}\p{N}])          # paren glued to the start of a word
+  | (?P<op> [|!()] )
+  | (?P<word> [\p{L}\p{N}.\#]+ )
+""", regex.VERSION1 | regex.VERBOSE)
+""" Tokenizer. Everything not matched is whitespace. Operators glued
+to words are treated as whitespace too. """
+
+RE_PREFIX = regex.compile (r'(\b\w+\.|#)(?=\w)', regex.VERSION1)
+RE_WILDCARD = regex.compile (r'\b\p{L}+$', regex.VERSION1)
+RE_ALNUM = regex.compile (r'[\p{L}\p{N}]', regex.VERSION1)
+
+cache = LRUCache (1000)
+""" Compiled queries keyed by raw query. """
+
+
+class Word (object):
+    """ A search word. """
+
+    def __init__ (self, word):
+        self.word = word
+
+    def echo (self):
+        return self.word
+
+    def tsquery (self):
+        return translate_word (self.word)
+
+
+class Not (object):
+    """ The '!' operator. """
+
+    def __init__ (self, operand):
+        self.operand = operand
+
+    def echo (self):
+        return '! ' + self.operand.echo ()
+
+    def tsquery (self):
+        return '! ' + self.operand.tsquery ()
+
+
+class Group (object):
+    """ A parenthesized subexpression. """
+
+    def __init__ (self, expr):
+        self.expr = expr
+
+    def echo (self):
+        return '( %s )' % self.expr.echo ()
+
+    def tsquery (self):
+        return '( %s )' % self.expr.tsquery ()
+
+
+class And (object):
+    """ Words juxtaposed. """
+
+    def __init__ (self, operands):
+        self.operands = operands
+
+    def echo (self):
+        return ' '.join ([o.echo () for o in self.operands])
+
+    def tsquery (self):
+        return ' & '.join ([o.tsquery () for o in self.operands])
+
+
+class Or (object):
+    """ The '|' operator. """
+
+    def __init__ (self, operands):
+        self.operands = operands
+
+    def echo (self):
+        return ' | '.join ([o.echo () for o in self.operands])
+
+    def tsquery (self):
+        return ' | '.join ([o.tsquery () for o in self.operands])
+
+
+def translate_prefix (match_object):
+    """ Translate from user-visible prefix to internal prefix. """
+    s = match_object.group (0)
+    return PREFIX_TO_PREFIX.get (s, s)
+
+
+def translate_word (word):
+    """ Translate one word from user syntax to postgres tsvec syntax. """
+
+    word = RE_PREFIX.sub (translate_prefix, word)
+    if RE_WILDCARD.search (word):
+        return word + ':*'
+    if word.endswith ('.'):
+        return word[:-1]
+    return word
+
+
+def tokenize (query):
+    """ Split query into a list of words and operators. """
+
+    tokens = []
+    for m in RE_TOKEN.finditer (query):
+        if m.group ('op'):
+            tokens.append (m.group ('op'))
+        elif m.group ('word'):
+            word = m.group ('word')
+            if RE_ALNUM.search (word):
+                tokens.append (Word (word))
+    return tokens
+
+
+class Parser (object):
+    """ Recursive descent parser with error recovery.
+
+    or_expr  := and_expr ('|' and_expr)*
+    and_expr := unary unary*
+    unary    := '!' unary | '(' or_expr ')' | word
+
+    Any subexpression may come out empty, eg. '( )' or a trailing
+    '!'. Empty subexpressions are dropped together with the operator
+    that needed them.
+
+    """
+
+    def __init__ (self, tokens):
+        self.tokens = tokens
+        self.pos = 0
+        self.depth = 0
+
+    def peek (self):
+        """ Return the next token or None. """
+        if self.pos < len (self.tokens):
+            return self.tokens[self.pos]
+        return None
+
+    def parse (self):
+        """ Parse the whole query. Returns the tree or None if empty. """
+        return self.or_expr ()
+
+    def or_expr (self):
+        operands = []
+        expr = self.and_expr ()
+        if expr is not None:
+            operands.append (expr)
+        while self.peek () == '|':
+            self.pos += 1
+            expr = self.and_expr ()
+            if expr is not None:
+                operands.append (expr)
+        if not operands:
+            return None
+        return operands[0] if len (operands) == 1 else Or (operands)
+
+    def and_expr (self):
+        operands = []
+        while True:
+            token = self.peek ()
+            if token is None or token == '|' or (token == ')' and self.depth):
+                break
+            if token == ')':
+                # unmatched ')' inside a sequence of words: skip it
+                self.pos += 1
+                continue
+            expr = self.unary ()
+            if expr is not None:
+                operands.append (expr)
+        if not operands:
+            return None
+        return operands[0] if len (operands) == 1 else And (operands)
+
+    def unary (self):
+        token = self.peek ()
+        self.pos += 1
+        if token == '!':
+            token = self.peek ()
+            if token is None or token in ('|', ')'):
+                return None
+            operand = self.unary ()
+            return None if operand is None else Not (operand)
+        if token == '(':
+            self.depth += 1
+            expr = self.or_expr ()
+            self.depth -= 1
+            if self.peek () == ')':
+                self.pos += 1
+                return None if expr is None else Group (expr)
+            # unmatched '(': drop it
+            return expr
+        return token
+
+
+class CompiledQuery (object):
+    """ The result of compiling a user query.
+
+    :ivar echo: The normalized query to show to the user.
+    :ivar tsquery: The query in postgres to_tsquery syntax.
+
+    """
+
+    def __init__ (self, tree):
+        if tree is None:
+            self.echo = ''
+            self.tsquery = ''
+        else:
+            self.echo = tree.echo ()
+            self.tsquery = tree.tsquery ()
+
+
+def compile_query (query):
+    """ Compile a user query. Returns a CompiledQuery. """
+
+    if not isinstance (query, str):
+        query = query[0] if isinstance (query, list) and len (query) > 0 else ''
+
+    compiled = cache.get (query)
+    if compiled is None:
+        compiled = CompiledQuery (Parser (tokenize (query)).parse ())
+        cache.put (query, compiled)
+    return compiled
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+#  -*- mode: python; indent-tabs-mode: nil; -*- coding: utf-8 -*-
+
+"""
+Sampler.py
+
+Distributable under the GNU General Public License Version 3 or newer.
+
+Random samples of book pks without asking postgres to sort a whole
+table by random ().
+
+Keeps arrays of the pks of all books and of all books that have a
+cover of a given size.
+
+Usage:
+  import Sampler
+  Sampler.load ()                 # in the timer thread
+  Sampler.sample ('books', 20)    # in the request thread
+
+"""
+
+from __future__ import unicode_literals
+
+import array
+import logging
+import random
+
+import cherrypy
+
+import ConnectionPool
+
+POOLS = {
+    'books':        "SELECT pk FROM books",
+    'cover.small':  "SELECT DISTINCT fk_books FROM files WHERE fk_filetypes = 'cover.small'",
+    'cover.medium': "SELECT DISTINCT fk_books FROM files WHERE fk_filetypes = 'cover.medium'",
+}
+""" Pool name => query that returns the pks in the pool. """
+
+pools = {}
+""" Pool name => array of pks """
+
+
+def load ():
+    """ (Re)load all pools from the database. Return True on success. """
+
+    global pools
+
+    conn = cherrypy.engine.pool.connect ()
+    c = conn.cursor ()
+    new_pools = {}
+    try:
+        c.execute (ConnectionPool.NO_TIMEOUT)
+        for name, query in POOLS.items ():
+            c.execute (query)
+            new_pools[name] = array.array ('i', [row[0] for row in c.fetchall ()])
+    except Exception as what:
+        cherrypy.log ("Cannot load sample pools: %s" % what,
+                      context = 'ENGINE', severity = logging.WARNING)
+        conn.rollback ()
+        return False
+
+    pools = new_pools
+    return True
+
+
+def sample (name, count):
+    """ Return up to count distinct random pks from pool name.
+
+    Returns None if the pool is not loaded yet.
+
+    """
+
+    pool = pools.get (name)
+    if not pool:
+        return None
+    return random.sample (pool, min (count, len (pool)))
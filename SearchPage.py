@@ -19,7 +19,10 @@ import cherrypy
 from libgutenberg.MediaTypes import mediatypes as mt
 from libgutenberg.DublinCore import DublinCore
 
+import AlsoDownloaded
 import BaseSearcher
+import Caches
+import Sampler
 from Page import SearchPage
 from i18n_tool import ugettext as _
 from i18n_tool import ungettext as __
@@ -53,10 +56,18 @@ class BookSearchPage (SearchPage):
                 os.title = os.title.replace(prefixed, repl)
 
         if os.sort_order == 'random':
-            sql.where.append ("pk in (select pk from books order by random() limit 20)")
+            pks = Sampler.sample ('books', 20)
+            if pks:
+                sql.where.append ("books.pk = ANY (%(random_pks)s)")
+                sql.params['random_pks'] = pks
+            else:
+                sql.where.append ("pk in (select pk from books order by random() limit 20)")
         if len (os.query):
             sql.fulltext ('books.tsvec', os.query)
             os.title = _("Books: {title}").format (title = os.title)
+            if os.start_index == 1:
+                # run this while the main search runs
+                os.queries.submit ('related_counts', self.related_counts, os.query)
         else:
             os.title = _('All Books')
 
@@ -97,56 +108,61 @@ class BookSearchPage (SearchPage):
             os.entries.insert (0, cat)
 
         if (len (os.query) and os.start_index == 1):
-            sql2 = BaseSearcher.SQLStatement ()
-            sql2.query = "select count (*) from bookshelves"
-            sql2.fulltext ('bookshelves.tsvec', os.query)
-            rows = BaseSearcher.SQLSearcher.execute (*sql2.build ())
-            if rows[0][0] > 0:
-                cat = BaseSearcher.Cat ()
-                cat.rel = 'related'
-                cat.title = _('Bookshelves')
-                cat.subtitle = __('One bookshelf matches your query.',
-                                  '{count} bookshelves match your search.',
-                                  rows[0][0]).format (count = rows[0][0])
-                cat.url = os.url ('bookshelf_search', query = os.query)
-                cat.class_ += 'navlink grayed'
-                cat.icon = 'bookshelf'
-                cat.order = 3
-                os.entries.insert (0, cat)
+            counts = os.queries.result ('related_counts')
+
+            related = (
+                ('bookshelves', 'bookshelf_search', 'bookshelf', _('Bookshelves'),
+                 __('One bookshelf matches your query.',
+                    '{count} bookshelves match your search.',
+                    counts['bookshelves'])),
+                ('subjects', 'subject_search', 'subject', _('Subjects'),
+                 __('One subject heading matches your search.',
+                    '{count} subject headings match your search.',
+                    counts['subjects'])),
+                ('authors', 'author_search', 'author', _('Authors'),
+                 __('One author name matches your search.',
+                    '{count} author names match your search.',
+                    counts['authors'])),
+            )
+
+            for table, route, icon, title, subtitle in related:
+                if counts[table] > 0:
+                    cat = BaseSearcher.Cat ()
+                    cat.rel = 'related'
+                    cat.title = title
+                    cat.subtitle = subtitle.format (count = counts[table])
+                    cat.url = os.url (route, query = os.query)
+                    cat.class_ += 'navlink grayed'
+                    cat.icon = icon
+                    cat.order = 3
+                    os.entries.insert (0, cat)
 
-            sql2 = BaseSearcher.SQLStatement ()
-            sql2.query = "select count (*) from subjects"
-            sql2.fulltext ('subjects.tsvec', os.query)
-            rows = BaseSearcher.SQLSearcher.execute (*sql2.build ())
-            if rows[0][0] > 0:
-                cat = BaseSearcher.Cat ()
-                cat.rel = 'related'
-                cat.title = _('Subjects')
-                cat.subtitle = __('One subject heading matches your search.',
-                                 '{count} subject headings match your search.',
-                                 rows[0][0]).format (count = rows[0][0])
-                cat.url = os.url ('subject_search', query = os.query)
-                cat.class_ += 'navlink grayed'
-                cat.icon = 'subject'
-                cat.order = 3
-                os.entries.insert (0, cat)
 
-            sql2 = BaseSearcher.SQLStatement ()
-            sql2.query = "select count (*) from authors"
-            sql2.fulltext ('authors.tsvec', os.query)
-            rows = BaseSearcher.SQLSearcher.execute (*sql2.build ())
-            if rows[0][0] > 0:
-                cat = BaseSearcher.Cat ()
-                cat.rel = 'related'
-                cat.title = _('Authors')
-                cat.subtitle = __('One author name matches your search.',
-                                  '{count} author names match your search.',
-                                  rows[0][0]).format (count = rows[0][0])
-                cat.url = os.url ('author_search', query = os.query)
-                cat.class_ += 'navlink grayed'
-                cat.icon = 'author'
-                cat.order = 3
-                os.entries.insert (0, cat)
+    @staticmethod
+    def related_counts (query):
+        """ Count the bookshelves, subjects and authors matching query.
+
+        Runs one statement and caches the counts per translated query.
+
+        """
+
+        tsquery = BaseSearcher.SQLStatement.translate_query (query)
+        cache = Caches.get ('related_counts')
+        counts = cache.get (tsquery)
+        if counts is None:
+            rows = BaseSearcher.SQLSearcher.execute (
+                """SELECT
+                     (SELECT count (*) FROM bookshelves
+                      WHERE bookshelves.tsvec @@ to_tsquery ('english', %(q)s)) AS bookshelves,
+                     (SELECT count (*) FROM subjects
+                      WHERE subjects.tsvec @@ to_tsquery ('english', %(q)s)) AS subjects,
+                     (SELECT count (*) FROM authors
+                      WHERE authors.tsvec @@ to_tsquery ('english', %(q)s)) AS authors""",
+                { 'q': tsquery })
+            counts = dict ((table, rows[0][table])
+                           for table in ('bookshelves', 'subjects', 'authors'))
+            cache.put (tsquery, counts)
+        return counts
 
 
 class AuthorSearchPage (SearchPage):
@@ -260,6 +276,20 @@ class AuthorPage (SearchPage):
         sql.where.append ("mn.fk_authors = %(fk_authors)s")
         sql.params['fk_authors'] = os.id
 
+        if os.start_index == 1:
+            # run these while the main search runs
+            os.queries.submit (
+                'author_urls', BaseSearcher.SQLSearcher.execute,
+                """SELECT url, description AS title FROM author_urls
+                   WHERE fk_authors = %(fk_authors)s""",
+                { 'fk_authors': os.id } )
+            if os.format == 'html':
+                os.queries.submit (
+                    'aliases', BaseSearcher.SQLSearcher.execute,
+                    """SELECT alias AS title FROM aliases
+                       WHERE fk_authors = %(fk_authors)s AND alias_heading = 1""",
+                    { 'fk_authors': os.id } )
+
     def fixup (self, os):
         for e in os.entries:
             if '$' in e.title:
@@ -280,10 +310,7 @@ class AuthorPage (SearchPage):
                 os.entries.insert (0, cat)
 
             # wikipedia links etc.
-            rows = BaseSearcher.SQLSearcher.execute (
-                """SELECT url, description AS title FROM author_urls
-                   WHERE fk_authors = %(fk_authors)s""",
-                { 'fk_authors': os.id } )
+            rows = os.queries.result ('author_urls')
             for row in rows:
                 cat = BaseSearcher.Cat ()
                 cat.type = mt.html
@@ -297,12 +324,7 @@ class AuthorPage (SearchPage):
 
             # author aliases
             if os.format  == 'html':
-                rows = BaseSearcher.SQLSearcher.execute (
-                    """SELECT alias AS title FROM aliases
-                       WHERE fk_authors = %(fk_authors)s AND alias_heading = 1""",
-                    { 'fk_authors': os.id }
-                    )
-
+                rows = os.queries.result ('aliases')
                 for row in rows:
                     cat = BaseSearcher.Cat ()
                     cat.title = _('Alias {alias}').format (alias = row.title)
@@ -360,6 +382,30 @@ class AlsoDownloadedPage (SearchPage):
         os.f_format_icon = os.format_icon_titles
         os.title = _('Readers also downloaded')
 
+        # a page past the precomputed rows needs the live query
+        top = AlsoDownloaded.lookup (os.id, os.start_index - 1 + os.items_per_page)
+        if top is not None:
+            # precomputed, see: AlsoDownloaded.py
+            sql.query = """
+                    SELECT
+                       books.pk,
+                       books.title,
+                       books.filing,
+                       books.author,
+                       books.release_date,
+                       books.fk_categories,
+                       books.fk_langs,
+                       books.coverpages,
+                       d.dl as downloads
+                    FROM
+                      v_appserver_books_4 as books
+                        JOIN unnest (%(pks)s::integer[], %(dls)s::integer[]) as d (pk, dl)
+                        ON d.pk = books.pk"""
+            sql.from_ = ()
+            sql.params['pks'] = list (top[0])
+            sql.params['dls'] = list (top[1])
+            return
+
         sql.query = """
                     SELECT
                        books.pk,
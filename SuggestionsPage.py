@@ -22,6 +22,7 @@ from libgutenberg.GutenbergDatabase import DatabaseError
 
 import BaseSearcher
 import Page
+import Vocabulary
 
 class Suggestions (Page.Page):
     """ Output the search suggestions page. """
@@ -59,6 +60,30 @@ class Suggestions (Page.Page):
         os.f_format_thumb_url = os.format_none
         os.f_format_icon = os.format_none
 
+        words = None
+        if len (os.query.split ()) == 1:
+            # the most frequent words of the whole catalog starting
+            # with the word. the database counts only in the books
+            # matching the stemmed prefix, which need not contain
+            # them: 'runni:*' does not match the stem 'run' of
+            # 'running'. so the database may suggest fewer words,
+            # with lower counts.
+            words = Vocabulary.complete (last_word, os.items_per_page + 1)
+
+        if words is not None:
+            os = self.sql_searcher.format_rows (os, [ { 'title': word } for word in words ])
+        else:
+            os = self.search (os, last_word)
+
+        os.template = os.page = 'results'
+        os.finalize ()
+
+        return self.format (os)
+
+
+    def search (self, os, last_word):
+        """ Count the words in the books matching the query. """
+
         sql = BaseSearcher.SQLStatement ()
 
         # prepare inner query
@@ -74,13 +99,8 @@ class Suggestions (Page.Page):
         sql.params['re_word'] = '^0' + last_word
 
         try:
-            os = self.sql_searcher.search (os, sql)
+            return self.sql_searcher.search (os, sql)
         except DatabaseError as what:
             cherrypy.log ("SQL Error: " + str (what),
                           context = 'REQUEST', severity = logging.ERROR)
             raise cherrypy.HTTPError (500, 'Internal Server Error.')
-
-        os.template = os.page = 'results'
-        os.finalize ()
-
-        return self.format (os)
@@ -42,7 +42,7 @@ class TemplatedPage (object):
         # Send HTTP content-type header.
         cherrypy.response.headers['Content-Type'] = self.CONTENT_TYPE
 
-        template = Formatters.formatters[self.FORMATTER].templates[template]
+        template = Formatters.formatters[self.FORMATTER].get_template (template)
         ctxt = genshi.template.Context (cherrypy = cherrypy, bs = BaseSearcher, **kwargs)
 
         stream = template.stream
@@ -2,10 +2,36 @@
 run this with
 python -m unittest -v Test
 '''
+import base64
+import datetime
+import gettext
+import json
 import os
+import tempfile
 import unittest
+from unittest import mock
 
+import cherrypy
+from cherrypy.lib import httputil
+import genshi.core
+import genshi.template
+import psycopg2
+
+import AlsoDownloaded
+import AuthorStats
+import BaseFormatter
+import BaseSearcher
+import BibrecPage
+import Bitmaps
+import Caches
 import CherryPyApp
+import ConnectionPool
+import Formatters
+import InvertedIndex
+import Prerender
+import QueryCompiler
+import Timer
+import Vocabulary
 
 class TestInstantiation(unittest.TestCase):
     def setUp(self):
@@ -16,3 +42,703 @@ class TestInstantiation(unittest.TestCase):
 
     def test_main(self):
         CherryPyApp.main()
+
+
+class TestQueryCompiler(unittest.TestCase):
+    def check(self, query, echo, tsquery):
+        compiled = QueryCompiler.compile_query(query)
+        self.assertEqual(compiled.echo, echo)
+        self.assertEqual(compiled.tsquery, tsquery)
+
+    def test_words(self):
+        self.check('Mark  Twain', 'Mark Twain', 'Mark:* & Twain:*')
+        self.check('"war, peace"', 'war peace', 'war:* & peace:*')
+
+    def test_prefixes(self):
+        self.check('a.twain #1342 l.en', 'a.twain #1342 l.en',
+                   'axtwain:* & no.1342 & l0en')
+
+    def test_operators(self):
+        self.check('dickens | ( collins ! woman )',
+                   'dickens | ( collins ! woman )',
+                   'dickens:* | ( collins:* & ! woman:* )')
+        self.check('(war) peace!', 'war peace', 'war:* & peace:*')
+
+    def test_repair(self):
+        self.check('| twain !', 'twain', 'twain:*')
+        self.check('( twain', 'twain', 'twain:*')
+        self.check('twain ) ( )', 'twain', 'twain:*')
+        self.check('a | | b', 'a | b', 'a:* | b:*')
+
+
+class TestCursor(unittest.TestCase):
+    def statement(self, query='twain:*'):
+        sql = BaseSearcher.SQLStatement()
+        sql.columns = ['pk', 'title']
+        sql.from_ = ['v_appserver_books_4 as books']
+        sql.where = ['books.tsvec @@ to_tsquery(%(q)s)']
+        sql.params = {'q': query}
+        return sql
+
+    @staticmethod
+    def token(data):
+        return base64.urlsafe_b64encode(json.dumps(data).encode('utf-8')).decode('ascii')
+
+    def test_roundtrip(self):
+        digest = self.statement().digest()
+        token = BaseSearcher.encode_cursor(digest, 'downloads', 26, 1234, 76)
+        self.assertEqual(BaseSearcher.decode_cursor(token, digest, 'downloads', 26), (1234, 76))
+
+    def test_author(self):
+        digest = self.statement().digest()
+        key = ['Twain, Mark', 'Clemens, Samuel']
+        token = BaseSearcher.encode_cursor(digest, 'author', 26, key, 76)
+        self.assertEqual(BaseSearcher.decode_cursor(token, digest, 'author', 26), (key, 76))
+        token = BaseSearcher.encode_cursor(digest, 'author', 26, ['Twain', 1], 76)
+        self.assertIsNone(BaseSearcher.decode_cursor(token, digest, 'author', 26))
+
+    def test_release_date(self):
+        digest = self.statement().digest()
+        token = BaseSearcher.encode_cursor(
+            digest, 'release_date', 26, datetime.date(2004, 3, 1), 76)
+        self.assertEqual(BaseSearcher.decode_cursor(token, digest, 'release_date', 26),
+                         ('2004-03-01', 76))
+
+    def test_stale(self):
+        digest = self.statement().digest()
+        token = BaseSearcher.encode_cursor(digest, 'downloads', 26, 1234, 76)
+        other = self.statement('dickens:*').digest()
+        self.assertNotEqual(digest, other)
+        self.assertIsNone(BaseSearcher.decode_cursor(token, other, 'downloads', 26))
+        self.assertIsNone(BaseSearcher.decode_cursor(token, digest, 'quantity', 26))
+        self.assertIsNone(BaseSearcher.decode_cursor(token, digest, 'downloads', 51))
+        self.assertIsNone(BaseSearcher.decode_cursor(token, digest, 'random', 26))
+
+    def test_bogus(self):
+        digest = self.statement().digest()
+        for token in ('', 'x', '!!!', 'bm90IGpzb24',
+                      self.token([digest, 'downloads', 26, 1, 'x']),
+                      self.token([digest, 'downloads', 26, {}, 1]),
+                      self.token([1, 2])):
+            self.assertIsNone(BaseSearcher.decode_cursor(token, digest, 'downloads', 26))
+
+    def test_digest_ignores_paging(self):
+        sql = self.statement()
+        digest = sql.digest()
+        sql.sort_order = 'downloads'
+        sql.start_index = 26
+        sql.items_per_page = 25
+        self.assertEqual(sql.digest(), digest)
+
+    def test_keyset_desc(self):
+        sql = self.statement()
+        sql.sort_order = 'release_date'
+        sql.start_index = 26
+        sql.items_per_page = 25
+        sql.cursor = ('2004-03-01', 76)
+        query, params = sql.build()
+        self.assertEqual(
+            query, "SELECT * FROM (SELECT pk, title FROM v_appserver_books_4 as books "
+            "WHERE books.tsvec @@ to_tsquery(%(q)s)) AS keyset "
+            "WHERE (release_date, pk) < (%(cursor_key)s, %(cursor_pk)s) "
+            "ORDER BY release_date DESC, pk DESC LIMIT %(limit)s")
+        self.assertEqual(params, {'q': 'twain:*', 'cursor_key': '2004-03-01',
+                                  'cursor_pk': 76, 'limit': 26})
+
+    def test_keyset_author(self):
+        sql = self.statement()
+        sql.sort_order = 'author'
+        sql.start_index = 26
+        sql.items_per_page = 25
+        sql.cursor = (['Twain, Mark'], 76)
+        query, params = sql.build()
+        self.assertIn("WHERE ((author, pk) > (%(cursor_key)s, %(cursor_pk)s) "
+                      "OR author IS NULL) ORDER BY author ASC, pk ASC LIMIT", query)
+        self.assertNotIn('OFFSET', query)
+        self.assertEqual(params['cursor_key'], ['Twain, Mark'])
+
+    def test_offset(self):
+        sql = self.statement()
+        sql.sort_order = 'author'
+        sql.start_index = 26
+        sql.items_per_page = 25
+        query, params = sql.build()
+        self.assertNotIn('keyset', query)
+        self.assertEqual(params['offset'], 25)
+
+
+class TestCaches(unittest.TestCase):
+    def test_clear_keeps_counters(self):
+        cache = Caches.get('test')
+        cache.put('key', [])
+        self.assertEqual(cache.get('key'), [])
+        Caches.clear_all()
+        self.assertIsNone(cache.get('key'))
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        self.assertIn('autocat3_cache_test_hits', Caches.metrics())
+
+    def test_sized(self):
+        cache = Caches.SizedCache(100, len)
+        cache.put('a', 'x' * 40)
+        cache.put('b', 'x' * 40)
+        self.assertEqual(cache.get('a'), 'x' * 40)
+        cache.put('c', 'x' * 40)
+        # 'b' was the least recently used
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual((cache.bytes, cache.evictions), (80, 1))
+        # too big to keep
+        cache.put('a', 'x' * 101)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.bytes, 40)
+        cache.invalidate('c')
+        self.assertEqual((cache.bytes, len(cache.data)), (0, 0))
+        self.assertEqual((cache.hits, cache.misses, cache.lookups), (1, 2, 3))
+
+    def test_approx_size(self):
+        small = Caches.approx_size({'files': ['a' * 10]})
+        big = Caches.approx_size({'files': ['a' * 10] * 2 + ['b' * 1000]})
+        self.assertGreater(big - small, 1000)
+        shared = ['x' * 1000]
+        self.assertLess(Caches.approx_size([shared], {id(shared)}), 1000)
+
+
+class TestPreparedStatements(unittest.TestCase):
+    def test_to_prepared(self):
+        name, text, names = ConnectionPool.to_prepared(
+            "SELECT * FROM books WHERE pk = %(pk)s AND pk != %(pk)s "
+            "AND title LIKE 'a%%' LIMIT %(limit)s")
+        self.assertTrue(name.startswith('autocat_'))
+        self.assertEqual(
+            text, "SELECT * FROM books WHERE pk = $1 AND pk != $1 "
+            "AND title LIKE 'a%' LIMIT $2")
+        self.assertEqual(names, ['pk', 'limit'])
+
+
+class TestParallelQueries(unittest.TestCase):
+    def setUp(self):
+        self.pool = ConnectionPool.ConnectionPool(cherrypy.engine)
+        patcher = mock.patch.object(cherrypy.engine, 'pool', self.pool, create=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.pool.stop)
+
+    def test_sequential_fallback(self):
+        # a pool that has not been started has no spare connections
+        queries = BaseSearcher.ParallelQueries()
+        queries.submit('sum', sum, [1, 2, 3])
+        queries.submit('fail', int, 'x')
+        self.assertEqual(queries.result('sum'), 6)
+        self.assertRaises(ValueError, queries.result, 'fail')
+
+    def test_parallel(self):
+        # the connections get made on first use, starting needs no database
+        with mock.patch.dict(cherrypy.config, {'sqlalchemy.pool_size': 3,
+                                               'sqlalchemy.max_overflow': 2}):
+            self.pool.start()
+        queries = BaseSearcher.ParallelQueries()
+        self.assertEqual(self.pool.spare_connections(), 3 + 2)
+        queries.submit('sum', sum, [1, 2, 3])
+        self.assertIn('sum', queries.futures)
+        self.assertEqual(queries.result('sum'), 6)
+
+
+class TestVocabulary(unittest.TestCase):
+    def test_complete(self):
+        index = Vocabulary.Index(
+            ['twain', 'twaine', 'twelve', 'twin'], [5, 1, 9, 7])
+        self.assertEqual(index.complete('twai', 6), ['twain', 'twaine'])
+        self.assertEqual(index.complete('tw', 2), ['twelve', 'twin'])
+        self.assertEqual(index.complete('x', 6), [])
+
+
+class TestBitmaps(unittest.TestCase):
+    def test_roundtrip(self):
+        pks = [1, 7, 8, 64, 99999]
+        bits = Bitmaps.from_pks(reversed(pks))
+        self.assertEqual(Bitmaps.to_pks(bits), pks)
+        self.assertEqual(Bitmaps.count(bits), 5)
+        self.assertEqual(Bitmaps.to_pks(bits & Bitmaps.from_pks([7, 9, 64])), [7, 64])
+        self.assertEqual(Bitmaps.to_pks(Bitmaps.from_pks([])), [])
+
+
+class TestDCView(unittest.TestCase):
+    def test_view(self):
+        from libgutenberg.GutenbergGlobals import Struct
+        snapshot = BaseSearcher.DC(None)
+        file_ = Struct()
+        file_.filetype = 'epub.images'
+        snapshot.files.append(file_)
+        snapshot.categories.append('Text')
+
+        dc = snapshot.view()
+        dc.files[0].filetype = 'html'
+        dc.files.append(Struct())
+        dc.categories.append('Sound')
+        dc.title = 'changed'
+        self.assertEqual(snapshot.files[0].filetype, 'epub.images')
+        self.assertEqual(len(snapshot.files), 1)
+        self.assertEqual(snapshot.categories, ['Text'])
+        self.assertNotEqual(snapshot.title, 'changed')
+
+
+class TestPretranslated(unittest.TestCase):
+    PAGE = """<html xmlns:py="http://genshi.edgewall.org/" xmlns:xi="http://www.w3.org/2001/XInclude"
+      xmlns:i18n="http://genshi.edgewall.org/i18n">
+  <xi:include href="part.html" />
+  <p title="Title">Title</p>
+  <p i18n:msg="count">${count} books</p>
+  <p>${count}</p>
+  ${footer ()}
+</html>"""
+
+    PART = """<html xmlns:py="http://genshi.edgewall.org/" py:strip="">
+  <py:def function="footer ()"><div>Footer</div></py:def>
+</html>"""
+
+    class Translations(gettext.NullTranslations):
+        MESSAGES = {'Title': 'Titel', '%(count)s books': '%(count)s Bücher', 'Footer': 'Fuß'}
+
+        def gettext(self, message):
+            return self.MESSAGES.get(message, message)
+
+    def test_same_output(self):
+        import i18n_tool
+        with tempfile.TemporaryDirectory() as template_dir:
+            for name, text in (('page.html', self.PAGE), ('part.html', self.PART)):
+                with open(os.path.join(template_dir, name), 'w') as fp:
+                    fp.write(text)
+            template = genshi.template.TemplateLoader(
+                template_dir, callback=Formatters.on_template_loaded).load('page.html')
+            translations = self.Translations()
+            cherrypy.response.i18n = i18n_tool.Struct()
+            cherrypy.response.i18n.trans = translations
+            try:
+                expected = template.generate(count=3).render('html')
+            finally:
+                del cherrypy.response.i18n
+            variant = BaseFormatter.pretranslated(template, translations)
+
+        self.assertEqual(variant.generate(count=3).render('html'), expected)
+        self.assertIn('3 Bücher', expected)
+        self.assertIn('Fuß', expected)
+
+    def test_fragments(self):
+        import HTMLFormatter
+        import i18n_tool
+        install_dir = os.path.dirname(os.path.abspath(__file__))
+        page = """<html xmlns="http://www.w3.org/1999/xhtml" xmlns:py="http://genshi.edgewall.org/"
+      xmlns:xi="http://www.w3.org/2001/XInclude">
+  <body>
+    <xi:include href="menu.html" />
+    <p py:for="i in range (3)">${i}</p>
+    <py:if test="True"><xi:include href="footer.html" /></py:if>
+  </body>
+</html>"""
+        formatter = HTMLFormatter.HTMLFormatter()
+        with tempfile.TemporaryDirectory() as template_dir:
+            with open(os.path.join(template_dir, 'page.html'), 'w') as fp:
+                fp.write(page)
+            for name in ('menu.html', 'footer.html'):
+                with open(os.path.join(install_dir, 'templates', name)) as src:
+                    with open(os.path.join(template_dir, name), 'w') as fp:
+                        fp.write(src.read())
+            formatter.set_template('page', genshi.template.TemplateLoader(
+                template_dir, callback=Formatters.on_template_loaded).load('page.html'))
+
+            cherrypy.response.i18n = i18n_tool.Struct()
+            cherrypy.response.i18n.trans = gettext.NullTranslations()
+            cherrypy.response.i18n.language = None
+            try:
+                spliced = formatter.render('page', None)
+                events = formatter.variants[('page', None)].stream
+                formatter.variants[('page', None)] = BaseFormatter.pretranslated(
+                    formatter.templates['page'], gettext.NullTranslations())
+                expected = formatter.render('page', None)
+            finally:
+                del cherrypy.response.i18n
+
+        self.assertEqual(spliced, expected)
+        self.assertIn(b'</footer>', expected)
+        self.assertEqual(len([e for e in events if e[0] is genshi.core.TEXT
+                              and e[1].startswith('<header')]), 1)
+
+
+class TestDCLoader(unittest.TestCase):
+    def test_against_load_from_database(self):
+        try:
+            conn = psycopg2.connect('')
+        except psycopg2.Error:
+            self.skipTest('no database')
+
+        class Pool:
+            def connect(self):
+                return conn
+
+        def dump(value, ordered=True):
+            # the loaders order authors, marcs and files, not the rest
+            if hasattr(value, '__dict__'):
+                return repr(sorted((name, dump(item, name in ('authors', 'marcs', 'files')))
+                                   for name, item in vars(value).items() if name != 'pool'))
+            if isinstance(value, (list, set)):
+                items = [dump(item) for item in value]
+                return repr(items if ordered and isinstance(value, list) else sorted(items))
+            return repr(value)
+
+        ids = [1, 11, 1342, 2701, 10000, 99999999]
+        dcs = BaseSearcher.DC.load_many(Pool(), ids)
+        for id_ in ids:
+            dc = BaseSearcher.DC(Pool())
+            dc.load_from_database(id_)
+            self.assertEqual(dump(dcs[id_]), dump(dc), id_)
+
+
+class TestBibrecCache(unittest.TestCase):
+    class Page(BibrecPage.BibrecPage):
+        renders = 0
+
+        def render(self, os, stamp=None):
+            self.renders += 1
+            cherrypy.response.headers['Content-Type'] = 'text/html; charset=UTF-8'
+            return ('page %d' % self.renders).encode('utf-8')
+
+    def setUp(self):
+        import i18n_tool
+        from libgutenberg.GutenbergGlobals import Struct
+        Caches.get('bibrec').clear()
+        BaseSearcher.dc_cache().clear()
+        BibrecPage.purges.clear()
+        self.addCleanup(BibrecPage.purges.clear)
+        cherrypy.response.i18n = i18n_tool.Struct()
+        cherrypy.response.i18n.locale = 'en'
+        self.addCleanup(delattr, cherrypy.response, 'i18n')
+        for name in ('method', 'headers'):
+            self.addCleanup(setattr, cherrypy.request, name, getattr(cherrypy.request, name))
+
+        self.os = Struct()
+        self.os.id = 1
+        self.os.format = 'html'
+        self.os.page_mode = 'screen'
+        self.os.lang = 'en'
+        self.os.host = 'www.gutenberg.org'
+        self.os.protocol = 'https'
+
+    def stamp(self, mtime=datetime.datetime(2020, 1, 1)):
+        with mock.patch.object(BibrecPage, 'file_stamp', return_value=(mtime, 3)):
+            return BibrecPage.page_stamp(1)
+
+    def test_hit_miss_invalidate(self):
+        page = self.Page()
+        stamp = self.stamp()
+        self.assertEqual(page.cached_render(self.os, stamp), b'page 1')
+        self.assertEqual(page.cached_render(self.os, stamp), b'page 1')
+
+        # another format is another page
+        self.os.format = 'opds'
+        self.assertEqual(page.cached_render(self.os, stamp), b'page 2')
+        self.os.format = 'html'
+        self.assertEqual(page.cached_render(self.os, stamp), b'page 1')
+
+        # changed files
+        stamp = self.stamp(datetime.datetime(2021, 1, 1))
+        self.assertEqual(page.cached_render(self.os, stamp), b'page 3')
+        self.assertEqual(page.cached_render(self.os, stamp), b'page 3')
+
+        # purged
+        BibrecPage.purge(1)
+        self.assertNotEqual(self.stamp(datetime.datetime(2021, 1, 1)), stamp)
+        stamp = self.stamp(datetime.datetime(2021, 1, 1))
+        self.assertEqual(page.cached_render(self.os, stamp), b'page 4')
+
+    def purge(self, token=None, method='POST'):
+        cherrypy.request.method = method
+        cherrypy.request.headers = httputil.HeaderMap()
+        if token is not None:
+            cherrypy.request.headers['X-Purge-Token'] = token
+        return BibrecPage.BibrecPurgePage().index(id='1')
+
+    def assertStatus(self, status, *args, **kwargs):
+        with self.assertRaises(cherrypy.HTTPError) as context:
+            self.purge(*args, **kwargs)
+        self.assertEqual(context.exception.status, status)
+
+    def test_purge_allowed(self):
+        BaseSearcher.dc_cache().put(1, 'dc')
+        with mock.patch.dict(cherrypy.config, {'bibrec.purge_token': 's3cret'}):
+            self.assertEqual(self.purge('s3cret'), b'purged\n')
+        self.assertEqual(BibrecPage.purges, {1: 1})
+        self.assertIsNone(BaseSearcher.dc_cache().get(1))
+
+    def test_purge_rejected(self):
+        BaseSearcher.dc_cache().put(1, 'dc')
+        with mock.patch.dict(cherrypy.config, {'bibrec.purge_token': 's3cret'}):
+            self.assertStatus(403)
+            self.assertStatus(403, 'wrong')
+            self.assertStatus(403, 's3cre')
+            self.assertStatus(405, 's3cret', method='GET')
+        # no token configured, no purging
+        self.assertStatus(403, '')
+        self.assertEqual(BibrecPage.purges, {})
+        self.assertEqual(BaseSearcher.dc_cache().get(1), 'dc')
+
+    def test_file_stamp(self):
+        try:
+            conn = psycopg2.connect('')
+        except psycopg2.Error:
+            self.skipTest('no database')
+
+        class Pool:
+            def connect(self):
+                return conn
+
+        with mock.patch.object(cherrypy.engine, 'pool', Pool(), create=True):
+            mtime, nfiles = BibrecPage.file_stamp(1342)
+        self.assertGreater(nfiles, 0)
+        self.assertIsInstance(mtime, datetime.datetime)
+
+
+class TestAlsoDownloaded(unittest.TestCase):
+    def test_lookup(self):
+        full = ([1] * AlsoDownloaded.TOP_N, [1] * AlsoDownloaded.TOP_N)
+        short = ([1, 2], [5, 3])
+        with mock.patch.object(AlsoDownloaded, 'index', {1: full, 2: short}):
+            self.assertIs(AlsoDownloaded.lookup(1), full)
+            self.assertIs(AlsoDownloaded.lookup(1, AlsoDownloaded.TOP_N), full)
+            self.assertIsNone(AlsoDownloaded.lookup(1, AlsoDownloaded.TOP_N + 1))
+            self.assertIs(AlsoDownloaded.lookup(2, 100), short)
+            self.assertIsNone(AlsoDownloaded.lookup(3))
+
+
+class TestAuthorStats(unittest.TestCase):
+    def test_loaded(self):
+        AuthorStats.counts = {1: 3, 2: 1}
+        try:
+            self.assertEqual(AuthorStats.book_counts([1, 2, 5]), {1: 3, 2: 1, 5: 0})
+        finally:
+            AuthorStats.counts = None
+
+
+class TestTimer(unittest.TestCase):
+    def setUp(self):
+        self.timer = Timer.TimerPlugin(cherrypy.engine)
+        self.results = {'good': [True], 'bad': [False, True]}
+        self.calls = []
+        patcher = mock.patch.object(BaseSearcher, 'books_in_archive', 10)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def loader(self, name):
+        def load():
+            self.calls.append(name)
+            result = self.results[name].pop(0)
+            if result is None:
+                raise ValueError(name)
+            return result
+        load.__module__ = name
+        return load
+
+    def tick(self, count):
+        loaders = [self.loader('good'), self.loader('bad')]
+        with mock.patch.object(BaseSearcher, 'sql_get', return_value=count), \
+             mock.patch.object(Timer.TimerPlugin, 'loaders', return_value=loaders), \
+             mock.patch.object(Caches, 'clear_all') as clear_all:
+            self.timer.load_catalog()
+        return clear_all.called
+
+    def test_unchanged(self):
+        self.assertFalse(self.tick(10))
+        self.assertEqual(self.calls, [])
+
+    def test_retry(self):
+        self.assertTrue(self.tick(11))
+        self.assertEqual(self.calls, ['good', 'bad'])
+        self.assertEqual(BaseSearcher.books_in_archive, 10)
+
+        # only the failed loader runs again
+        self.assertFalse(self.tick(11))
+        self.assertEqual(self.calls, ['good', 'bad', 'bad'])
+        self.assertEqual(BaseSearcher.books_in_archive, 11)
+
+    def test_exception(self):
+        self.results['bad'] = [None, True]
+        with mock.patch.object(cherrypy, 'log') as log:
+            self.tick(11)
+        self.assertEqual(self.calls, ['good', 'bad'])
+        self.assertIn('bad.load failed', log.call_args[0][0])
+        self.assertEqual(BaseSearcher.books_in_archive, 10)
+
+
+class TestPrerender(unittest.TestCase):
+    def test_no_session(self):
+        # the prerender app runs with sessions off
+        self.assertFalse(hasattr(cherrypy.serving, 'session'))
+        self.assertEqual(BaseSearcher.session(), {})
+        session = {'last_visited': [1]}
+        with mock.patch.object(cherrypy.serving, 'session', session, create=True):
+            self.assertIs(BaseSearcher.session(), session)
+
+    def test_changes(self):
+        manifest = {'version': 1.0, 'books': {1: ['2020', 1], 2: ['2020', 1], 3: ['2020', 1]}}
+        stamps = {1: ['2020', 1], 2: ['2021', 1], 4: ['2020', 2]}
+        self.assertEqual(Prerender.changes(manifest, stamps, 1.0), ([2, 4], [3]))
+        self.assertEqual(Prerender.changes(manifest, stamps, 2.0), ([1, 2, 4], [3]))
+        self.assertEqual(Prerender.changes(manifest, stamps, 1.0, True), ([1, 2, 4], [3]))
+
+
+class TestInvertedIndex(unittest.TestCase):
+    DOCS = [
+        (1, 10, datetime.date(2001, 1, 1), ['twain', 'mark', 'l0en', 'huckleberri']),
+        (2, 30, datetime.date(2003, 1, 1), ['dicken', 'charl', 'l0en']),
+        (3, 20, datetime.date(2002, 1, 1), ['twain', 'tom', 'l0de']),
+        (4, 20, None, ['collin', 'woman', 'white', 'l0en']),
+        (5, 5, datetime.date(2005, 1, 1), None),
+    ]
+
+    QUERIES = [
+        "'twain'", "'twa':*", "'l0en' & !'dicken'", "!'twain'",
+        "'dicken' | 'collin' & !'woman'", "( 'dicken' | 'collin' ) & !'woman'",
+        "'nothing'",
+    ]
+
+    @staticmethod
+    def matches(node, lexemes):
+        op = node[0]
+        if op == 'lexeme':
+            return any(lex == node[1] or (node[2] and lex.startswith(node[1]))
+                       for lex in lexemes)
+        if op == '!':
+            return not TestInvertedIndex.matches(node[1], lexemes)
+        left = TestInvertedIndex.matches(node[1], lexemes)
+        right = TestInvertedIndex.matches(node[2], lexemes)
+        return left and right if op == '&' else left or right
+
+    def test_decoded_cache(self):
+        cache = InvertedIndex.DecodedCache(80)
+        cache.put('a', set(range(10)))
+        cache.put('b', set(range(10, 20)))
+        self.assertEqual(cache.get('a'), set(range(10)))
+        # too big to cache
+        cache.put('big', set(range(11)))
+        self.assertIsNone(cache.get('big'))
+        for key in 'cdefghi':
+            cache.put(key, set(range(10)))
+        # 'b' was the least recently used
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), set(range(10)))
+        self.assertEqual(cache.size, 80)
+        cache.put('a', set())
+        self.assertEqual(cache.size, 70)
+
+    def test_codec(self):
+        pks = [1, 2, 127, 128, 300, 70000, 2 ** 31 - 1]
+        self.assertEqual(InvertedIndex.decode(InvertedIndex.encode(pks)), pks)
+
+    def test_against_brute_force(self):
+        index = InvertedIndex.Index.build(self.DOCS)
+        for query in self.QUERIES:
+            node = InvertedIndex.parse_tsquery(query)
+            expected = {pk for pk, dl, date, lexemes in self.DOCS
+                        if lexemes is not None and self.matches(node, lexemes)}
+            self.assertEqual(set(index.search(query, 'downloads', 0, 100)),
+                             expected, query)
+
+    def test_order(self):
+        index = InvertedIndex.Index.build(self.DOCS)
+        self.assertEqual(index.search("'l0en'", 'downloads', 0, 10), [2, 4, 1])
+        self.assertEqual(index.search("'l0en'", 'downloads', 1, 1), [4])
+        # NULLs first, like ORDER BY release_date DESC
+        self.assertEqual(index.search("'l0en'", 'release_date', 0, 10), [4, 2, 1])
+
+    def test_decline(self):
+        self.assertRaises(InvertedIndex.Decline, InvertedIndex.parse_tsquery,
+                          "'mark' <-> 'twain'")
+        self.assertIsNone(InvertedIndex.parse_tsquery(''))
+
+    def test_against_database(self):
+        try:
+            conn = psycopg2.connect('')
+        except psycopg2.Error:
+            self.skipTest('no database')
+        where = 'WHERE pk < 2000'
+        InvertedIndex.load(conn, where)
+        c = conn.cursor()
+        for query in ('twain', 'l.en ! a.twain', 'dickens | collins', 'hist'):
+            tsquery = BaseSearcher.SQLStatement.translate_query(query)
+            c.execute("SELECT to_tsquery('english', %s)::text", (tsquery, ))
+            normalized = c.fetchone()[0]
+            c.execute("SELECT pk FROM v_appserver_books_4 %s "
+                      "AND tsvec @@ to_tsquery('english', %%s)" % where, (tsquery, ))
+            expected = {row[0] for row in c.fetchall()}
+            found = InvertedIndex.index.search(normalized, 'downloads', 0, 5000)
+            self.assertEqual(set(found), expected, query)
+
+
+class TestAdvSearchEntries(unittest.TestCase):
+    """ The advresults page loads its books in a fixed number of statements. """
+
+    SCHEMA = [
+        "CREATE TABLE books (pk INTEGER PRIMARY KEY, copyrighted INTEGER, "
+        "release_date DATE, downloads INTEGER, title TEXT)",
+        "CREATE TABLE authors (pk INTEGER PRIMARY KEY, author TEXT, born_floor INTEGER, "
+        "died_floor INTEGER, born_ceil INTEGER, died_ceil INTEGER)",
+        "CREATE TABLE aliases (pk INTEGER PRIMARY KEY, fk_authors INTEGER, alias TEXT, "
+        "alias_heading INTEGER)",
+        "CREATE TABLE roles (pk TEXT PRIMARY KEY, role TEXT)",
+        "CREATE TABLE mn_books_authors (fk_books INTEGER, fk_authors INTEGER, "
+        "fk_roles TEXT, heading INTEGER)",
+        "CREATE TABLE langs (pk TEXT PRIMARY KEY, lang TEXT)",
+        "CREATE TABLE mn_books_langs (fk_books INTEGER, fk_langs TEXT)",
+        "CREATE TABLE categories (pk INTEGER PRIMARY KEY, category TEXT)",
+        "CREATE TABLE mn_books_categories (fk_books INTEGER, fk_categories INTEGER)",
+        "INSERT INTO roles VALUES ('aut', 'Author')",
+        "INSERT INTO langs VALUES ('en', 'English')",
+        "INSERT INTO categories VALUES (1, 'Audio Book, computer-generated')",
+    ]
+
+    def setUp(self):
+        from sqlalchemy import create_engine, event
+        from sqlalchemy.orm import Session
+
+        engine = create_engine('sqlite://')
+        with engine.begin() as conn:
+            for statement in self.SCHEMA:
+                conn.exec_driver_sql(statement)
+            for pk in range(1, 51):
+                conn.exec_driver_sql(
+                    "INSERT INTO books VALUES (?, 0, '2020-01-01', 0, ?)", (pk, 'Title %d' % pk))
+                conn.exec_driver_sql(
+                    "INSERT INTO authors VALUES (?, ?, 1835, 1910, NULL, NULL)",
+                    (pk, 'Author %d' % pk))
+                conn.exec_driver_sql(
+                    "INSERT INTO mn_books_authors VALUES (?, ?, 'aut', 1)", (pk, pk))
+                conn.exec_driver_sql("INSERT INTO mn_books_langs VALUES (?, 'en')", (pk, ))
+                conn.exec_driver_sql("INSERT INTO mn_books_categories VALUES (?, 1)", (pk, ))
+
+        self.statements = 0
+        def count(*args):
+            self.statements += 1
+        event.listen(engine, 'before_cursor_execute', count)
+        self.session = Session(engine)
+
+    def render(self, pks):
+        """ Touch what advresults.html touches and return the statement count. """
+        import AdvSearchPage
+        from libgutenberg.DublinCore import DublinCore
+
+        self.statements = 0
+        self.session.expunge_all()
+        for book in AdvSearchPage.entries(self.session, pks):
+            str(book.pk) + book.title + str(book.is_audiobook)
+            for author in book.authors:
+                author.first_letter + str(author.id)
+                DublinCore.format_author_date_role(author)
+            [lang.language for lang in book.langs]
+        return self.statements
+
+    def test_statements(self):
+        self.assertEqual(self.render([1, 2]), 4)
+        self.assertEqual(self.render(list(range(50, 0, -1))), 4)
+
+    def test_order(self):
+        import AdvSearchPage
+        books = AdvSearchPage.entries(self.session, [3, 1, 2])
+        self.assertEqual([book.pk for book in books], [3, 1, 2])
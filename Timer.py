@@ -18,9 +18,19 @@ Usage:
 
 from __future__ import unicode_literals
 
+import logging
+import threading
+
 import cherrypy
 
+import AlsoDownloaded
+import AuthorStats
 import BaseSearcher
+import Bitmaps
+import Caches
+import InvertedIndex
+import Sampler
+import Vocabulary
 
 
 class TimerPlugin (cherrypy.process.plugins.Monitor):
@@ -36,16 +46,76 @@ class TimerPlugin (cherrypy.process.plugins.Monitor):
         frequency = 300
         super (TimerPlugin, self).__init__ (bus, self.tick, frequency)
         self.name = 'timer'
+        self.lock = threading.Lock ()
+        self.loading = None
+        """ The catalog size the pending loaders are loading for. """
+        self.pending = []
+        """ The loaders that did not succeed yet. """
 
     def start (self):
         super (TimerPlugin, self).start ()
-        self.tick ()
+        # the first loads take minutes, don't hold up the engine start
+        threading.Thread (target = self.tick, name = 'timer-startup', daemon = True).start ()
     start.priority = 80
 
+    @staticmethod
+    def loaders ():
+        """ The loaders to run when the catalog changed. """
+
+        loaders = [Bitmaps.load, AuthorStats.load, Sampler.load, Vocabulary.load]
+        if InvertedIndex.enabled ():
+            loaders.append (InvertedIndex.load)
+        return loaders
+
+    @staticmethod
+    def run (loader):
+        """ Run a loader. Return True if it succeeded. """
+
+        try:
+            return loader ()
+        except Exception as what:
+            cherrypy.log ("%s.load failed: %s" % (loader.__module__, what),
+                          context = 'ENGINE', severity = logging.ERROR)
+            return False
+
     def tick (self):
         """ Do things here. """
 
+        if not self.lock.acquire (blocking = False):
+            # the last tick is still loading
+            return
+        try:
+            self.load_catalog ()
+            self.run (AlsoDownloaded.load)
+        finally:
+            self.lock.release ()
+
+    def load_catalog (self):
+        """ Reload the in-memory indexes if the catalog changed.
+
+        books_in_archive advances only after all loaders succeeded.
+        The failed ones are retried on the next tick.
+
+        """
+
         try:
-            BaseSearcher.books_in_archive = BaseSearcher.sql_get ('select count (*) from books')
-        except:
-            pass
+            books_in_archive = BaseSearcher.sql_get ('select count (*) from books')
+        except Exception as what:
+            cherrypy.log ("Cannot count books: %s" % what,
+                          context = 'ENGINE', severity = logging.ERROR)
+            return
+
+        if books_in_archive == BaseSearcher.books_in_archive:
+            self.loading = None
+            return
+
+        if books_in_archive != self.loading:
+            # the catalog changed
+            Caches.clear_all ()
+            self.loading = books_in_archive
+            self.pending = self.loaders ()
+
+        self.pending = [loader for loader in self.pending if not self.run (loader)]
+        if not self.pending:
+            BaseSearcher.books_in_archive = books_in_archive
+            self.loading = None
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+#  -*- mode: python; indent-tabs-mode: nil; -*- coding: utf-8 -*-
+
+"""
+Vocabulary.py
+
+Distributable under the GNU General Public License Version 3 or newer.
+
+In-memory prefix index of the words in the catalog, for the search
+suggestions.
+
+The index holds the unstemmed words of all books' tsvectors (the
+words with the '0' prefix, see: QueryCompiler.PREFIX_TO_PREFIX) as a
+sorted list together with the number of their occurrences. A prefix
+lookup is a binary search for the range of words starting with the
+prefix plus a top-k selection on that range.
+
+Usage:
+  import Vocabulary
+  Vocabulary.load ()                # in the timer thread
+  Vocabulary.complete ('twai', 6)   # in the request thread
+
+"""
+
+from __future__ import unicode_literals
+
+import array
+import bisect
+import heapq
+import logging
+
+import cherrypy
+
+import ConnectionPool
+
+
+class Index (object):
+    """ A sorted vocabulary with frequencies. """
+
+    def __init__ (self, words = (), nentries = ()):
+        self.words = list (words)
+        self.nentries = array.array ('i', nentries)
+
+
+    def __len__ (self):
+        return len (self.words)
+
+
+    def range (self, prefix):
+        """ Return the index range of the words starting with prefix. """
+
+        lo = bisect.bisect_left (self.words, prefix)
+        return lo, bisect.bisect_left (self.words, prefix + '\U0010ffff', lo)
+
+
+    def complete (self, prefix, limit):
+        """ Return the `limit` most frequent words starting with prefix,
+        most frequent first. """
+
+        words = self.words
+        nentries = self.nentries
+        lo, hi = self.range (prefix)
+        best = heapq.nlargest (limit, range (lo, hi), key = nentries.__getitem__)
+        return [words[i] for i in best]
+
+
+index = Index ()
+
+
+def load (conn = None):
+    """ (Re)load the vocabulary from the database.
+
+    Reads all tsvectors, so call this only when the catalog changed.
+    Return True on success.
+
+    """
+
+    global index
+
+    if conn is None:
+        conn = cherrypy.engine.pool.connect ()
+    c = conn.cursor ()
+    try:
+        c.execute (ConnectionPool.NO_TIMEOUT)
+        c.execute ("""SELECT substr (word, 2), nentry
+                      FROM ts_stat ('SELECT tsvec FROM books')
+                      WHERE word LIKE '0%'""")
+        rows = sorted (c.fetchall ())
+    except Exception as what:
+        cherrypy.log ("Cannot load vocabulary: %s" % what,
+                      context = 'ENGINE', severity = logging.WARNING)
+        conn.rollback ()
+        return False
+
+    # replace, don't update, so readers never see a half-loaded index
+    index = Index ([row[0] for row in rows], [row[1] for row in rows])
+    return True
+
+
+def complete (prefix, limit):
+    """ Return the `limit` most frequent words starting with prefix.
+
+    Returns None if the index is not loaded yet.
+
+    """
+
+    if not len (index):
+        return None
+    return index.complete (prefix.lower (), limit)
@@ -217,14 +217,16 @@ def load_translation(languages, dirname, domain, default):
         domain : String
             Gettext domain of the catalog (`tools.I18nTool.domain`).
 
-    :returns: Lang object with two attributes (Lang.trans = the translations
-              object, Lang.locale = the corresponding Locale object).
+    :returns: Lang object with three attributes (Lang.trans = the translations
+              object, Lang.locale = the corresponding Locale object,
+              Lang.language = the locale of the translations or None).
     :rtype: Lang
     :raises: ImproperlyConfigured if no locale where known.
     """
 
     res = Struct ()
     res.trans = gettext.NullTranslations ()
+    res.language = None
 
     try:
         # use the preferred locale for date formatting
@@ -243,12 +245,14 @@ def load_translation(languages, dirname, domain, default):
             # cached ?
             if (domain, locale) in _trans_cache:
                 res.trans = _trans_cache[(domain, locale)]
+                res.language = locale
                 return res
 
             # not cached
             trans = Translations.load (dirname, locale, domain)
             if isinstance (trans, Translations):
                 res.trans = _trans_cache [(domain, locale)] = trans
+                res.language = locale
                 break
 
         except (ValueError, UnknownLocaleError):
@@ -0,0 +1,33 @@
+-- Indexes for the substring terms of the advanced search.
+--
+-- pg_trgm GIN indexes answer ILIKE '%word%' without a sequential scan.
+-- The summaries get a full-text index instead, see: AdvSearchPage.term_query.
+-- The expressions and partial index predicates must match the queries.
+--
+-- Run once with: psql -f sql/advsearch_trgm.sql
+
+CREATE EXTENSION IF NOT EXISTS pg_trgm SCHEMA public;
+
+-- titles: Attribute.fk_attriblist IN (240, 245, 246)
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_attributes_title_trgm
+  ON attributes USING gin (text gin_trgm_ops)
+  WHERE fk_attriblist IN (240, 245, 246);
+
+-- summaries: Attribute.fk_attriblist = 520
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_attributes_summary_fts
+  ON attributes USING gin (to_tsvector ('simple'::regconfig, text))
+  WHERE fk_attriblist = 520;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_authors_author_trgm
+  ON authors USING gin (author gin_trgm_ops);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_aliases_alias_trgm
+  ON aliases USING gin (alias gin_trgm_ops);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_subjects_subject_trgm
+  ON subjects USING gin (subject gin_trgm_ops);
+
+ANALYZE attributes;
+ANALYZE authors;
+ANALYZE aliases;
+ANALYZE subjects;
@@ -0,0 +1,12 @@
+-- Precomputed "Readers also downloaded" lists.
+--
+-- One row per book: the books most often downloaded together with it,
+-- best first, and how often. Filled by: python AlsoDownloaded.py
+
+CREATE TABLE IF NOT EXISTS scores.also_downloads_top (
+  fk_books  integer   PRIMARY KEY,
+  pks       integer[] NOT NULL,
+  dls       integer[] NOT NULL
+);
+
+GRANT SELECT ON scores.also_downloads_top TO PUBLIC;